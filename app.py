@@ -1,31 +1,33 @@
 
 import os
+from collections import OrderedDict
 from datetime import datetime, date, timedelta, timezone
 import pytz
 import pandas as pd
 import numpy as np
 
-from dash import Dash, dcc, html, Input, Output, State, dash_table
+from flask import Response, g, request
+from dash import Dash, dcc, html, Input, Output, State, dash_table, ctx, no_update
 import dash_bootstrap_components as dbc
 import plotly.graph_objs as go
 
-from sqlalchemy import create_engine
-from sqlalchemy.pool import NullPool
-
-from hl_fsm import detect_hl_patterns, run_backtest_on_df
-from polygon_client import fetch_aggs_range
+from hl_fsm import HLDetector, bars_from_df
+from resample import RES_MS, fetch_range
+from candle_store import load_candles
+from db import make_engine
+import charts
+import jobs
+import metrics
+import scanner
+from market_calendar import is_trading_day, previous_trading_day
 
 LOG_LEVEL = os.getenv("LOG_LEVEL","INFO").upper()
 
 POLYGON_API_KEY = os.environ.get("POLYGON_API_KEY")
-SUPABASE_DB_URL = os.environ.get("SUPABASE_DB_URL")  # postgres connection string
-if SUPABASE_DB_URL and "sslmode" not in SUPABASE_DB_URL:
-    if "?" in SUPABASE_DB_URL:
-        SUPABASE_DB_URL += "&sslmode=require"
-    else:
-        SUPABASE_DB_URL += "?sslmode=require"
-
-engine = create_engine(SUPABASE_DB_URL, poolclass=NullPool) if SUPABASE_DB_URL else None
+LANDING_REFRESH_SECONDS = int(os.environ.get("LANDING_REFRESH_SECONDS", "30"))
+SIGNAL_POLL_MS = 5000
+SIGNAL_ROWS = 50
+JOB_POLL_MS = 1000
 
 US_EASTERN = pytz.timezone("America/New_York")
 
@@ -47,13 +49,11 @@ def is_market_hours(now_utc=None):
     now_et = now_utc.astimezone(US_EASTERN)
     start = now_et.replace(hour=9, minute=0, second=0, microsecond=0)
     end   = now_et.replace(hour=16, minute=30, second=0, microsecond=0)
-    return start <= now_et <= end and now_et.weekday() < 5
+    return start <= now_et <= end and is_trading_day(now_et.date())
 
 def last_trading_day_et(today=None):
     d = today or datetime.now(US_EASTERN).date()
-    while d.weekday() >= 5:
-        d = d - timedelta(days=1)
-    return d
+    return previous_trading_day(d)
 
 external_stylesheets = [dbc.themes.BOOTSTRAP]
 app = Dash(__name__, external_stylesheets=external_stylesheets, suppress_callback_exceptions=True)
@@ -88,23 +88,39 @@ app.layout = dbc.Container([
 landing_layout = dbc.Container([
     dbc.Row([
         dbc.Col(dbc.Input(id="symbol", placeholder="Symbol (e.g., AAPL)", value="AAPL"), md=3),
+        dbc.Col(dcc.Dropdown(id="landing-res", clearable=False, value="minute",
+                             options=[{"label": "5-minute bars", "value": "5minute"}, {"label": "Minute bars", "value": "minute"},
+                                      {"label": "Second bars", "value": "second"}]), md=2),
         dbc.Col(dbc.Button("Refresh Now", id="btn-refresh", color="primary"), md=2),
-        dbc.Col(html.Div(id="market-status"), md=7)
+        dbc.Col(html.Div(id="market-status"), md=5)
     ], className="my-2"),
-    dcc.Graph(id="main-chart")
+    dcc.Graph(id="main-chart"),
+    dcc.Interval(id="landing-interval", interval=LANDING_REFRESH_SECONDS*1000),
+    dcc.Store(id="landing-state"),
+    dcc.Store(id="landing-new-marks"),
+    html.H5("Scanner signals", className="mt-3"),
+    dash_table.DataTable(id="signal-feed", page_size=10,
+                         columns=[{"name": c, "id": c} for c in ("ts", "symbol", "kind", "price", "profit")]),
+    dcc.Interval(id="signal-poll", interval=SIGNAL_POLL_MS)
 ], fluid=True)
 
 backtest_layout = dbc.Container([
     dbc.Row([
-        dbc.Col(dbc.Input(id="bt-symbol", placeholder="Symbol", value="AAPL"), md=2),
+        dbc.Col(dbc.Input(id="bt-symbol", placeholder="Symbol(s), comma separated", value="AAPL"), md=2),
         dbc.Col(dcc.DatePickerRange(id="bt-range"), md=4),
         dbc.Col(dbc.Button("Run Backtest", id="btn-bt", color="primary"), md=2),
         dbc.Col(dbc.Button("Parameters", id="btn-bt-params", color="secondary"), md=2),
+        dbc.Col(dbc.Button("Cancel", id="btn-bt-cancel", color="danger", outline=True), md=1),
     ], className="my-2"),
     dbc.Collapse(parameter_inputs(prefix="bt-"), id="bt-params-collapse", is_open=False),
+    dbc.Progress(id="bt-progress", value=0, className="my-2"),
+    dcc.Store(id="bt-job"),
+    dcc.Interval(id="bt-job-poll", interval=JOB_POLL_MS, disabled=True),
     html.Hr(),
     html.Div(id="bt-summary"),
-    dash_table.DataTable(id="bt-by-period", page_size=10, sort_action="native")
+    dash_table.DataTable(id="bt-by-period", page_size=10, sort_action="native"),
+    html.H5("Leaderboard", className="mt-3"),
+    dash_table.DataTable(id="bt-leaderboard", page_size=20, sort_action="native")
 ], fluid=True)
 
 def param_columns():
@@ -148,6 +164,23 @@ fine_layout = dbc.Container([
         dbc.Col(dbc.Button("Run Fine Tuning", id="btn-ft", color="primary"), md=2),
         dbc.Col(dbc.Button("Parameters Grid (10 sets)", id="btn-ft-params", color="secondary"), md=3),
     ], className="my-2"),
+    dbc.Row([
+        dbc.Col(dcc.Dropdown(id="ft-grid-mode", clearable=False, value="table", options=[
+            {"label": "Grid: table rows", "value": "table"},
+            {"label": "Grid: random", "value": "random"},
+            {"label": "Grid: Latin hypercube", "value": "lhs"},
+        ]), md=3),
+        dbc.Col(dbc.Input(id="ft-grid-size", type="number", value=1000, min=1, step=1, placeholder="Sets"), md=2),
+        dbc.Col(dcc.Dropdown(id="ft-search", clearable=False, value="exhaustive", options=[
+            {"label": "Search: every set on every day", "value": "exhaustive"},
+            {"label": "Search: successive halving", "value": "halving"},
+        ]), md=3),
+        dbc.Col(dbc.Button("Cancel", id="btn-ft-cancel", color="danger", outline=True), md=1),
+    ], className="my-2"),
+    dbc.Progress(id="ft-progress", value=0, className="my-2"),
+    html.Div(id="ft-status"),
+    dcc.Store(id="ft-job"),
+    dcc.Interval(id="ft-job-poll", interval=JOB_POLL_MS, disabled=True),
     dbc.Collapse(
         dash_table.DataTable(
             id="ft-table", columns=param_columns(), data=default_ft_rows(), editable=True, page_size=10
@@ -158,6 +191,7 @@ fine_layout = dbc.Container([
 ], fluid=True)
 
 @app.callback(Output("tab-content","children"), Input("tabs","value"))
+@metrics.timed_callback
 def render_tab(tab):
     if tab == "landing":
         return landing_layout
@@ -168,45 +202,152 @@ def render_tab(tab):
 
 from hl_fsm import DEFAULT_PARAMS as FSM_DEFAULTS
 
+# Day bars, marks and detector per (symbol, resolution, day), kept in the
+# worker so refreshes never round-trip a day of bars through the browser. A
+# worker without the entry simply reloads the day.
+_landing_cache = OrderedDict()
+LANDING_CACHE_SIZE = 8
+
+_engine = None
+
+def get_engine():
+    # Created on first use, so each gunicorn worker opens its own pool.
+    global _engine
+    if _engine is None:
+        _engine = make_engine()
+    return _engine
+
+def _landing_entry(key, day, res, symbol):
+    # The day so far through the candle store (bar store, Postgres, then
+    # Polygon for what neither holds); refreshes fetch only the live tail.
+    df = load_candles(get_engine(), symbol, res, day, day, POLYGON_API_KEY)
+    if df is None or df.empty:
+        return None
+    df = df[df['ts'].dt.tz_convert(US_EASTERN).dt.date == day]
+    det = HLDetector(FSM_DEFAULTS)
+    _, marks = det.feed(df)
+    ts, low, high, close = bars_from_df(df)
+    entry = {
+        "bars": {"ts": ts, "open": df['open'].to_numpy(dtype=np.float64), "high": high, "low": low, "close": close},
+        "marks": [[m['ts'].value // 10**6, m['price'], m['label']] for m in marks],
+        "detector": det,
+    }
+    _landing_cache[key] = entry
+    while len(_landing_cache) > LANDING_CACHE_SIZE:
+        _landing_cache.popitem(last=False)
+    return entry
+
+def _append_bars(entry, df, day):
+    # Feed bars newer than the detector's last timestamp; returns the index
+    # of the first appended bar and the new marks.
+    df = df[df['ts'].dt.tz_convert(US_EASTERN).dt.date == day]
+    det = entry["detector"]
+    df = df[df['ts'] > pd.Timestamp(det.last_ts, unit='ms', tz='UTC')]
+    bars = entry["bars"]
+    n0 = len(bars['ts'])
+    if df.empty:
+        return n0, []
+    _, marks = det.feed(df)
+    ts, low, high, close = bars_from_df(df)
+    for k, v in (("ts", ts), ("open", df['open'].to_numpy(dtype=np.float64)), ("high", high), ("low", low), ("close", close)):
+        bars[k] = np.concatenate([bars[k], v])
+    new_marks = [[m['ts'].value // 10**6, m['price'], m['label']] for m in marks]
+    entry["marks"].extend(new_marks)
+    return n0, new_marks
+
 @app.callback(
     Output("market-status","children"),
     Output("main-chart","figure"),
+    Output("main-chart","extendData", allow_duplicate=True),
+    Output("landing-state","data"),
+    Output("landing-new-marks","data"),
+    Output("landing-interval","disabled"),
     Input("btn-refresh","n_clicks"),
+    Input("landing-interval","n_intervals"),
+    Input("main-chart","relayoutData"),
     State("symbol","value"),
-    prevent_initial_call=False
+    State("landing-res","value"),
+    State("landing-state","data"),
+    prevent_initial_call='initial_duplicate'
 )
-def update_landing(n, symbol):
+@metrics.timed_callback
+def update_landing(n, n_intervals, relayout, symbol, res, state):
     now = datetime.now(timezone.utc)
-    if is_market_hours(now):
-        status = "Market hours (ET). Showing today's minute data."
-        start = datetime.now(US_EASTERN).date()
-        end = start
+    live = is_market_hours(now)
+    res = res or "minute"
+    if live:
+        status = f"Market hours (ET). Showing today's {res} data."
+        day = datetime.now(US_EASTERN).date()
     else:
-        status = "Off hours. Showing last full trading day's minute data."
-        end = last_trading_day_et()
-        start = end
-
-    df = fetch_aggs_range(symbol, 1, "minute", start, end, POLYGON_API_KEY)
+        status = f"Off hours. Showing last full trading day's {res} data."
+        day = last_trading_day_et()
+    symbol = (symbol or "").upper()
+    key = (symbol, res, day.isoformat())
+    base_ms = RES_MS[res]
+    same_view = bool(state) and tuple(state["key"]) == key
+    entry = _landing_cache.get(key) if same_view else None
+
+    if ctx.triggered_id == "main-chart":
+        # Zoom/pan: re-bin just the visible window at the finest bin that fits.
+        rng = charts.parse_relayout(relayout)
+        if rng is False or entry is None:
+            return no_update, no_update, no_update, no_update, no_update, no_update
+        fig, bin_ms = charts.figure(entry["bars"], entry["marks"], base_ms, *rng)
+        return (status, fig, no_update, dict(state, view=list(rng), bin_ms=bin_ms, points=len(fig.data[0].x)),
+                no_update, not live)
+
+    if entry is None:
+        entry = _landing_entry(key, day, res, symbol)
+        if entry is None:
+            fig = go.Figure()
+            fig.update_layout(title="No data")
+            return status, fig, no_update, None, None, not live
+        fig, bin_ms = charts.figure(entry["bars"], entry["marks"], base_ms)
+        return (status, fig, no_update, {"key": key, "view": [None, None], "bin_ms": bin_ms, "points": len(fig.data[0].x)},
+                None, not live)
+
+    det = entry["detector"]
+    day_end = US_EASTERN.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    # bars from the one after the last fed; derived bars are only ever fed complete
+    df = fetch_range(symbol, res, det.last_ts + base_ms, int(day_end.timestamp()*1000) - 1, POLYGON_API_KEY)
     if df is None or df.empty:
-        fig = go.Figure()
-        fig.update_layout(title="No data")
-        return status, fig
-
-    events, marks = detect_hl_patterns(df, FSM_DEFAULTS)
-
-    fig = go.Figure(data=[go.Candlestick(
-        x=df['ts'], open=df['open'], high=df['high'], low=df['low'], close=df['close']
-    )])
-    if marks:
-        fig.add_trace(go.Scatter(
-            x=[m['ts'] for m in marks],
-            y=[m['price'] for m in marks],
-            mode="markers+text",
-            text=[m['label'] for m in marks],
-            textposition="top center"
-        ))
-    fig.update_layout(xaxis_rangeslider_visible=False)
-    return status, fig
+        return status, no_update, no_update, no_update, no_update, not live
+    n0, new_marks = _append_bars(entry, df, day)
+    if n0 == len(entry["bars"]['ts']):
+        return status, no_update, no_update, no_update, no_update, not live
+
+    points = state.get("points", 0) + len(entry["bars"]['ts']) - n0
+    if state.get("bin_ms") == base_ms and points <= charts.MAX_POINTS:
+        # Raw candles on screen: append only the new ones.
+        return (status, no_update, charts.extend_candles(entry["bars"], n0), dict(state, points=points),
+                new_marks or no_update, not live)
+    # Binned view, or raw candles outgrowing MAX_POINTS: rebuild the figure.
+    fig, bin_ms = charts.figure(entry["bars"], entry["marks"], base_ms, *state.get("view", [None, None]))
+    return status, fig, no_update, dict(state, bin_ms=bin_ms, points=len(fig.data[0].x)), no_update, not live
+
+@app.callback(
+    Output("main-chart","extendData", allow_duplicate=True),
+    Input("landing-new-marks","data"),
+    prevent_initial_call=True
+)
+@metrics.timed_callback
+def push_landing_marks(marks):
+    if not marks:
+        return no_update
+    return charts.extend_marks(marks)
+
+@app.callback(
+    Output("signal-feed","data"),
+    Input("signal-poll","n_intervals")
+)
+@metrics.timed_callback
+def update_signal_feed(n):
+    # Latest signals published by the scanner process, newest first.
+    signals = scanner.read_feed()[-SIGNAL_ROWS:]
+    if not signals:
+        return no_update if n else []
+    return [{"ts": s["ts"], "symbol": s["symbol"], "kind": s["kind"], "price": round(s["price"], 4),
+             "profit": round(s["profit"], 4) if "profit" in s else None} for s in reversed(signals)]
 
 @app.callback(
     Output("bt-params-collapse","is_open"),
@@ -214,14 +355,31 @@ def update_landing(n, symbol):
     State("bt-params-collapse","is_open"),
     prevent_initial_call=True
 )
+@metrics.timed_callback
 def toggle_bt_params(n, is_open): 
     return not is_open
 
+def _job_progress(job_id):
+    # (job, percent, label) for a tab's progress bar
+    job = jobs.get(job_id) if job_id else None
+    if job is None:
+        return None, 0, ""
+    pct = int(100 * job["done"] / job["total"]) if job["total"] else 0
+    return job, pct, job["note"] or job["status"]
+
 @app.callback(
     Output("bt-summary","children"),
     Output("bt-by-period","data"),
     Output("bt-by-period","columns"),
+    Output("bt-leaderboard","data"),
+    Output("bt-leaderboard","columns"),
+    Output("bt-job","data"),
+    Output("bt-job-poll","disabled"),
+    Output("bt-progress","value"),
+    Output("bt-progress","label"),
     Input("btn-bt","n_clicks"),
+    Input("btn-bt-cancel","n_clicks"),
+    Input("bt-job-poll","n_intervals"),
     State("bt-symbol","value"),
     State("bt-range","start_date"),
     State("bt-range","end_date"),
@@ -235,59 +393,43 @@ def toggle_bt_params(n, is_open):
     State("bt-time_to_wait_before_confirm_Ax_ms","value"),
     State("bt-price_increase_from_A2_to_enter_trade","value"),
     State("bt-trade_timeout_ms","value"),
+    State("bt-job","data"),
     prevent_initial_call=True
 )
-def run_backtest(n, symbol, start_date, end_date, *param_values):
-    from hl_fsm import DEFAULT_PARAMS as FSM_DEFAULTS
-    params = dict(zip(list(FSM_DEFAULTS.keys()), param_values)) if param_values and len(param_values)==len(FSM_DEFAULTS) else FSM_DEFAULTS
-    start = datetime.fromisoformat(start_date).date()
-    end   = datetime.fromisoformat(end_date).date()
-
-    all_days = pd.date_range(start, end, freq='D')
-    df_all = []
-    for d in all_days:
-        df = fetch_aggs_range(symbol, 1, "minute", d.date(), d.date(), POLYGON_API_KEY)
-        if df is None or df.empty:
-            continue
-        df_all.append(df)
-        if engine:
-            df.to_sql("candles_minute", engine, if_exists="append", index=False)
-
-    if not df_all:
-        return "No data found in range.", [], []
-
-    data = pd.concat(df_all, ignore_index=True)
-    occ = run_backtest_on_df(data, params)
-
-    total = len(occ)
-    wins = sum(1 for o in occ if o.get('outcome') == 'take_profit')
-    win_rate = (wins/total*100) if total else 0.0
-    avg_profit = float(np.mean([o.get('profit',0) for o in occ])) if occ else 0.0
-    summary = f"Patterns: {total} | Win%: {win_rate:.1f}% | Avg P/L: ${avg_profit:.02f}"
-
-    span_days = (end - start).days + 1
-    if span_days <= 31:
-        grp = "W"
-    elif span_days <= 370:
-        grp = "M"
-    else:
-        grp = "Y"
-
-    if occ:
-        df_occ = pd.DataFrame(occ)
-        period_map = {'W':'W','M':'M','Y':'Y'}
-        df_occ['period'] = pd.to_datetime(df_occ['a0_time']).dt.to_period(period_map[grp]).astype(str)
-        agg = df_occ.groupby('period').agg(
-            patterns=('a0_time','count'),
-            wins=('outcome', lambda s: (s=='take_profit').sum()),
-            avg_profit=('profit','mean')
-        ).reset_index()
-        cols = [{"name":c, "id":c} for c in agg.columns]
-        rows = agg.to_dict('records')
-    else:
-        cols, rows = [], []
-
-    return summary, rows, cols
+@metrics.timed_callback
+def run_backtest(n, n_cancel, n_poll, symbol, start_date, end_date, *rest):
+    # Submits the backtest as a background job, then polls it until done.
+    # Several symbols run as a universe backtest with a per-symbol leaderboard.
+    *param_values, job_id = rest
+    if ctx.triggered_id == "btn-bt":
+        # universe pulls in the database stack, which web workers otherwise never need
+        from universe import parse_symbols
+        params = dict(zip(list(FSM_DEFAULTS.keys()), param_values))
+        symbols = parse_symbols(symbol)
+        args = {
+            "start": datetime.fromisoformat(start_date).date().isoformat(),
+            "end": datetime.fromisoformat(end_date).date().isoformat(),
+            "params": params
+        }
+        if len(symbols) > 1:
+            job_id = jobs.submit("universe", dict(args, symbols=symbols))
+        else:
+            job_id = jobs.submit("backtest", dict(args, symbol=symbols[0] if symbols else ""))
+        return "Queued.", [], [], [], [], job_id, False, 0, ""
+    if ctx.triggered_id == "btn-bt-cancel" and job_id:
+        jobs.cancel(job_id)
+
+    job, pct, label = _job_progress(job_id)
+    if job is None:
+        return no_update, no_update, no_update, no_update, no_update, None, True, 0, ""
+    if job["status"] == "done":
+        r = job["result"]
+        return (r["summary"], r["rows"], r["cols"], r.get("leaders", []), r.get("leader_cols", []),
+                no_update, True, 100, "")
+    if job["status"] in ("failed", "cancelled"):
+        return (f"Backtest {job['status']}. {job['error'] or ''}", no_update, no_update, no_update, no_update,
+                no_update, True, pct, label)
+    return f"Backtest {job['status']}.", no_update, no_update, no_update, no_update, no_update, False, pct, label
 
 @app.callback(
     Output("ft-params-collapse","is_open"),
@@ -295,60 +437,81 @@ def run_backtest(n, symbol, start_date, end_date, *param_values):
     State("ft-params-collapse","is_open"),
     prevent_initial_call=True
 )
+@metrics.timed_callback
 def toggle_ft_params(n, is_open): 
     return not is_open
 
 @app.callback(
     Output("ft-results","data"),
     Output("ft-results","columns"),
+    Output("ft-status","children"),
+    Output("ft-job","data"),
+    Output("ft-job-poll","disabled"),
+    Output("ft-progress","value"),
+    Output("ft-progress","label"),
     Input("btn-ft","n_clicks"),
+    Input("btn-ft-cancel","n_clicks"),
+    Input("ft-job-poll","n_intervals"),
     State("ft-symbol","value"),
     State("ft-range","start_date"),
     State("ft-range","end_date"),
     State("ft-table","data"),
+    State("ft-grid-mode","value"),
+    State("ft-grid-size","value"),
+    State("ft-search","value"),
+    State("ft-job","data"),
     prevent_initial_call=True
 )
-def run_fine_tuning(n, symbol, start_date, end_date, rows):
-    start = datetime.fromisoformat(start_date).date()
-    end   = datetime.fromisoformat(end_date).date()
-
-    all_days = pd.date_range(start, end, freq='D')
-    df_all = []
-    for d in all_days:
-        df = fetch_aggs_range(symbol, 1, "second", d.date(), d.date(), POLYGON_API_KEY)
-        if df is None or df.empty:
-            continue
-        df_all.append(df)
-        if engine:
-            df.to_sql("candles_second", engine, if_exists="append", index=False)
-
-    if not df_all:
-        return [], []
-
-    sec_df = pd.concat(df_all, ignore_index=True)
-
-    results = []
-    for r in rows:
-        params = {k:r[k] for k in r if k!="set_id"}
-        occ = run_backtest_on_df(sec_df, params)
-        total = len(occ)
-        wins = sum(1 for o in occ if o.get('outcome') == 'take_profit')
-        win_rate = (wins/total*100) if total else 0.0
-        avg_profit = float(np.mean([o.get('profit',0) for o in occ])) if occ else 0.0
-        results.append({
-            "set_id": r["set_id"],
-            "patterns": total,
-            "win_rate_pct": round(win_rate,1),
-            "avg_profit": round(avg_profit, 4)
+@metrics.timed_callback
+def run_fine_tuning(n, n_cancel, n_poll, symbol, start_date, end_date, rows, grid_mode, grid_size, search, job_id):
+    if ctx.triggered_id == "btn-ft":
+        job_id = jobs.submit("fine_tune", {
+            "symbol": (symbol or "").upper(),
+            "start": datetime.fromisoformat(start_date).date().isoformat(),
+            "end": datetime.fromisoformat(end_date).date().isoformat(),
+            "rows": rows, "grid_mode": grid_mode or "table", "grid_size": grid_size,
+            "search": search or "exhaustive"
         })
-    cols = [{"name":c, "id":c} for c in results[0].keys()] if results else []
-    return results, cols
-
-if __name__ == "__main__":
-    port = int(os.environ.get("PORT", "8080"))
-    app.run_server(host="0.0.0.0", port=port, debug=False)
-    # Health check endpoint for DigitalOcean
+        return [], [], "Queued.", job_id, False, 0, ""
+    if ctx.triggered_id == "btn-ft-cancel" and job_id:
+        jobs.cancel(job_id)
+
+    job, pct, label = _job_progress(job_id)
+    if job is None:
+        return no_update, no_update, no_update, None, True, 0, ""
+    if job["status"] == "done":
+        r = job["result"]
+        return r["rows"], r["cols"], r.get("note", ""), no_update, True, 100, ""
+    if job["status"] in ("failed", "cancelled"):
+        return no_update, no_update, f"Fine tuning {job['status']}. {job['error'] or ''}", no_update, True, pct, label
+    return no_update, no_update, f"Fine tuning {job['status']}.", no_update, False, pct, label
+
+@server.before_request
+def _start_profile():
+    if metrics.PROFILE_SLOW_MS:
+        body = request.get_json(silent=True) if request.is_json else None
+        name = request.path + ("-" + body["output"] if isinstance(body, dict) and "output" in body else "")
+        g.profile = metrics.profiled(name)
+        g.profile.__enter__()
+
+@server.teardown_request
+def _stop_profile(exc):
+    prof = g.pop("profile", None)
+    if prof is not None:
+        prof.__exit__(None, None, None)
+
+# Health check endpoint for DigitalOcean
 @server.get("/health")
 def health():
     return "ok", 200
 
+@server.get("/metrics")
+def metrics_endpoint():
+    return Response(metrics.collect(), mimetype="text/plain; version=0.0.4")
+
+if __name__ == "__main__":
+    # Local runs host their own job workers; deployments start jobs.py next to gunicorn.
+    metrics.export()
+    jobs.start_workers()
+    port = int(os.environ.get("PORT", "8080"))
+    app.run_server(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,151 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+# Local on-disk tier in front of Postgres: one directory of fixed-dtype .npy
+# columns per (symbol, resolution, day), opened memory-mapped so reads skip
+# the Decimal round trip and come from the OS page cache. Consumers still copy
+# what they use (the kernel into plain lists or its feature index). Only
+# completed days are stored, so a stored day never changes.
+#
+#   BAR_STORE_DIR/<res>/<SYMBOL>/<YYYY-MM-DD>/{ts,open,high,low,close,volume,vwap,trades}.npy
+
+BAR_STORE_DIR = os.environ.get("BAR_STORE_DIR", os.path.join(tempfile.gettempdir(), "hl_bars"))
+BAR_STORE_MAX_BYTES = int(float(os.environ.get("BAR_STORE_MAX_BYTES", str(2 * 1024**3))))
+
+DTYPES = {"ts": np.int64, "open": np.float64, "high": np.float64, "low": np.float64,
+          "close": np.float64, "volume": np.float64, "vwap": np.float64, "trades": np.int64}
+# trades has no NaN; missing counts are stored as this
+NO_TRADES = -1
+
+_evict_lock = threading.Lock()
+
+def enabled():
+    return bool(BAR_STORE_DIR) and BAR_STORE_MAX_BYTES > 0
+
+def _day_dir(symbol, res, day):
+    return os.path.join(BAR_STORE_DIR, res, symbol.upper(), day.isoformat())
+
+def put_day(symbol, res, day, df):
+    # Writes the columns to a scratch directory and renames it into place, so
+    # readers see either the whole day or nothing. An existing day is kept.
+    final = _day_dir(symbol, res, day)
+    if os.path.isdir(final):
+        return
+    parent = os.path.dirname(final)
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        n = 0 if df is None else len(df)
+        cols = {}
+        if n:
+            cols["ts"] = df['ts'].values.astype('datetime64[ms]').astype(np.int64)
+            for c in ("open", "high", "low", "close", "volume", "vwap"):
+                cols[c] = df[c].to_numpy(dtype=np.float64, na_value=np.nan)
+            cols["trades"] = df['trades'].astype("Int64").fillna(NO_TRADES).to_numpy(dtype=np.int64)
+        for c, dt in DTYPES.items():
+            np.save(os.path.join(tmp, c + ".npy"), np.ascontiguousarray(cols.get(c, np.empty(0, dtype=dt)), dtype=dt))
+        os.rename(tmp, final)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(final):
+            raise
+
+def get_day(symbol, res, day):
+    # Column name -> read-only memmapped array, or None if the day is not stored.
+    path = _day_dir(symbol, res, day)
+    try:
+        cols = {}
+        for c in DTYPES:
+            cols[c] = np.load(os.path.join(path, c + ".npy"), mmap_mode="r")
+        os.utime(path)  # recency for eviction
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return cols
+
+class BarRange:
+    # Consecutive stored days addressed as one range without concatenating
+    # them: per-day column arrays plus the offset of each day's first bar.
+    def __init__(self, days, cols):
+        self.days = list(days)
+        self.cols = list(cols)
+        self.offsets = np.cumsum([0] + [len(c["ts"]) for c in self.cols])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def segments(self):
+        # (day, ts, low, high, close) per non-empty day, in order, as the
+        # kernel takes them; carry the FSM state from one to the next.
+        for d, c in zip(self.days, self.cols):
+            if len(c["ts"]):
+                yield d, c["ts"], c["low"], c["high"], c["close"]
+
+def get_range(symbol, res, days):
+    # BarRange over the given days if every one of them is stored, else None.
+    cols = []
+    for d in days:
+        c = get_day(symbol, res, d)
+        if c is None:
+            return None
+        cols.append(c)
+    return BarRange(days, cols)
+
+def to_frame(symbol, cols):
+    # The day as a candle frame in the shape load_candles returns.
+    if not len(cols["ts"]):
+        return pd.DataFrame()
+    trades = np.asarray(cols["trades"])
+    counts = pd.array(trades, dtype="Int64")
+    counts[trades == NO_TRADES] = pd.NA
+    return pd.DataFrame({
+        "symbol": symbol.upper(),
+        "ts": pd.to_datetime(np.asarray(cols["ts"]), unit="ms", utc=True),
+        **{c: np.asarray(cols[c]) for c in ("open", "high", "low", "close", "volume", "vwap")},
+        "trades": counts,
+    })
+
+def _dir_size(path):
+    return sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+
+def evict(max_bytes=None):
+    # Drops least recently read days until the store fits in max_bytes.
+    max_bytes = BAR_STORE_MAX_BYTES if max_bytes is None else max_bytes
+    if not os.path.isdir(BAR_STORE_DIR):
+        return 0
+    with _evict_lock:
+        days = []
+        for res in os.scandir(BAR_STORE_DIR):
+            if not res.is_dir():
+                continue
+            for sym in os.scandir(res.path):
+                if not sym.is_dir():
+                    continue
+                for day in os.scandir(sym.path):
+                    if day.is_dir() and not day.name.startswith(".tmp-"):
+                        st = day.stat()
+                        days.append((st.st_mtime, day.path, _dir_size(day.path)))
+        total = sum(s for _, _, s in days)
+        removed = 0
+        for _, path, size in sorted(days):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        if removed:
+            log.info("bar store: evicted %d days", removed)
+        return removed
+
+def put_days(symbol, res, frames):
+    # frames: day -> frame, e.g. from split_by_day; then trims the store.
+    for d, f in frames.items():
+        put_day(symbol, res, d, f)
+    evict()
@@ -0,0 +1,211 @@
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import warnings
+from datetime import date, datetime
+
+import requests
+from requests.adapters import BaseAdapter
+
+# Offline benchmarks for the HL pipeline: FSM throughput on synthetic bars,
+# page decoding on recorded Polygon pages, period aggregation, the backtest
+# job end to end with Polygon served from the fixtures, and web worker
+# start-up (import app, then the first page load).
+#
+#   python bench.py                 compare against benchmarks/baseline.json
+#   python bench.py --save          write the baseline
+#   python bench.py --record        re-record the JSON fixtures
+#
+# Exits 1 when a result is worse than the baseline by more than --threshold.
+
+os.environ.pop("SUPABASE_DB_URL", None)
+os.environ["BAR_STORE_MAX_BYTES"] = "0"  # no local bar store: every run is cold
+os.environ["DERIVE_FROM_SECONDS"] = "0"  # the backtest fixture is minute aggregates
+warnings.filterwarnings("ignore", message="Converting to PeriodArray")
+
+import polygon_client
+import result_cache
+import tasks
+from candle_store import _day_bounds_utc
+from hl_fsm import DEFAULT_PARAMS, bars_from_df, initial_state, run_backtest_on_df, run_kernel
+from synthetic import aggs_page, synthetic_bars
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, "benchmarks", "fixtures")
+BASELINE = os.path.join(HERE, "benchmarks", "baseline.json")
+
+START, END = date(2024, 3, 4), date(2024, 3, 8)
+SECOND_FIXTURE_ROWS = 3600
+
+def record_fixtures():
+    os.makedirs(FIXTURES, exist_ok=True)
+    pages = {
+        "minute": synthetic_bars(START, END, "minute", seed=1),
+        "second": synthetic_bars(START, START, "second", seed=1).head(SECOND_FIXTURE_ROWS),
+    }
+    for res, df in pages.items():
+        with open(os.path.join(FIXTURES, f"aggs_{res}.json"), "w") as f:
+            json.dump(aggs_page(df), f, separators=(",", ":"))
+
+def load_fixture(res):
+    with open(os.path.join(FIXTURES, f"aggs_{res}.json")) as f:
+        return json.load(f)
+
+class FixtureAdapter(BaseAdapter):
+    # Answers aggregate range requests with the fixture bars inside the
+    # requested days.
+    def __init__(self, page):
+        super().__init__()
+        self.results = page["results"]
+
+    def send(self, request, **kwargs):
+        parts = request.path_url.split("?")[0].split("/")
+        lo, hi = (int(t.timestamp() * 1000) for t in
+                  _day_bounds_utc(date.fromisoformat(parts[-2]), date.fromisoformat(parts[-1])))
+        page = dict(results=[r for r in self.results if lo <= r["t"] < hi], status="OK")
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.raw = io.BytesIO(json.dumps(page).encode())
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def close(self):
+        pass
+
+def best_of(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def bench_fsm(res, repeat):
+    df = synthetic_bars(START, END if res == "minute" else START, res)
+    bars = bars_from_df(df)
+    secs = best_of(lambda: run_kernel(*bars, DEFAULT_PARAMS, initial_state(), collect_marks=False), repeat)
+    return len(df) / secs
+
+def bench_decode(res, repeat):
+    results = load_fixture(res)["results"]
+    secs = best_of(lambda: polygon_client.decode_page(results, "SYN"), repeat)
+    return len(results) / secs
+
+def bench_periods(repeat):
+    occ = run_backtest_on_df(synthetic_bars(date(2023, 1, 3), date(2023, 12, 29), "minute"), DEFAULT_PARAMS)
+    secs = best_of(lambda: tasks.period_rows(occ, date(2023, 1, 3), date(2023, 12, 29)), repeat)
+    return len(occ) / secs
+
+def bench_backtest_job(repeat):
+    # Cold run: no database or bar store, empty result cache, Polygon answered locally.
+    session = polygon_client.get_session()
+    session.mount(polygon_client.API_ROOT, FixtureAdapter(load_fixture("minute")))
+    tasks.POLYGON_API_KEY = "bench"
+    args = {"start": START.isoformat(), "end": END.isoformat(), "params": DEFAULT_PARAMS}
+
+    def run():
+        result_cache.day_cache.data.clear()
+        out = tasks.backtest_job(dict(args, symbol="SYN"), lambda done, total, note=None: None)
+        assert out["rows"], "fixture backtest found no patterns"
+
+    return best_of(run, repeat) * 1000
+
+# Run in a fresh interpreter: import time of app.py, then the requests a
+# browser makes on first load, ending with the backtest tab.
+STARTUP_CODE = """
+import json, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+c = app.server.test_client()
+for path in ("/", "/_dash-layout", "/_dash-dependencies"):
+    assert c.get(path).status_code == 200, path
+r = c.post("/_dash-update-component", json={
+    "output": "tab-content.children", "outputs": {"id": "tab-content", "property": "children"},
+    "inputs": [{"id": "tabs", "property": "value", "value": "backtest"}], "changedPropIds": ["tabs.value"]})
+assert r.status_code == 200
+print(json.dumps({"import": t1 - t0, "first_request": time.perf_counter() - t1}))
+"""
+
+def bench_startup(field, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", STARTUP_CODE], cwd=HERE, capture_output=True, text=True,
+                             check=True, env=dict(os.environ, PYTHONWARNINGS="ignore"))
+        best = min(best, json.loads(out.stdout.strip().splitlines()[-1])[field])
+    return best * 1000
+
+# name -> (unit, higher is better, fn(repeat))
+BENCHMARKS = {
+    "fsm_minute": ("bars/s", True, lambda r: bench_fsm("minute", r)),
+    "fsm_second": ("bars/s", True, lambda r: bench_fsm("second", r)),
+    "decode_minute": ("rows/s", True, lambda r: bench_decode("minute", r)),
+    "decode_second": ("rows/s", True, lambda r: bench_decode("second", r)),
+    "period_rows": ("events/s", True, bench_periods),
+    "backtest_job": ("ms", False, bench_backtest_job),
+    "import_app": ("ms", False, lambda r: bench_startup("import", r)),
+    "first_request": ("ms", False, lambda r: bench_startup("first_request", r)),
+}
+
+def run(names, repeat):
+    out = {}
+    for name in names:
+        unit, higher, fn = BENCHMARKS[name]
+        out[name] = {"value": fn(repeat), "unit": unit, "higher_is_better": higher}
+        print(f"{name:16s} {out[name]['value']:14,.1f} {unit}")
+    return out
+
+def regressions(results, baseline, threshold):
+    # Names whose result is worse than the baseline by more than threshold.
+    bad = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base or not base["value"]:
+            continue
+        change = r["value"] / base["value"] - 1
+        if not r["higher_is_better"]:
+            change = -change
+        if change < -threshold:
+            bad.append((name, change))
+    return bad
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Offline HL pipeline benchmarks")
+    ap.add_argument("names", nargs="*", help="benchmarks to run (default all): " + ", ".join(BENCHMARKS))
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--threshold", type=float, default=0.20, help="allowed slowdown as a fraction")
+    ap.add_argument("--baseline", default=BASELINE)
+    ap.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    ap.add_argument("--record", action="store_true", help="re-record the JSON fixtures")
+    a = ap.parse_args(argv)
+    unknown = [n for n in a.names if n not in BENCHMARKS]
+    if unknown:
+        ap.error("unknown benchmark(s): " + ", ".join(unknown))
+
+    if a.record or not os.path.exists(os.path.join(FIXTURES, "aggs_minute.json")):
+        record_fixtures()
+    results = run(a.names or list(BENCHMARKS), a.repeat)
+
+    if a.save:
+        os.makedirs(os.path.dirname(a.baseline), exist_ok=True)
+        with open(a.baseline, "w") as f:
+            json.dump({"saved_at": datetime.now().isoformat(timespec="seconds"), "results": results}, f, indent=2)
+        print(f"baseline written to {a.baseline}")
+        return 0
+    if not os.path.exists(a.baseline):
+        print("no baseline; run with --save first")
+        return 0
+    with open(a.baseline) as f:
+        baseline = json.load(f)["results"]
+    bad = regressions(results, baseline, a.threshold)
+    for name, change in bad:
+        print(f"REGRESSION {name}: {change:+.1%} vs baseline")
+    return 1 if bad else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
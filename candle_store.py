@@ -0,0 +1,219 @@
+import logging
+from datetime import datetime, time, timedelta
+import pandas as pd
+import pytz
+from sqlalchemy import text
+
+import bar_store
+import metrics
+import resample
+from market_calendar import chunk_days, trading_days
+from ingest import copy_candles, writer
+from polygon_client import fetch_aggs_days, split_by_day
+
+log = logging.getLogger(__name__)
+
+US_EASTERN = pytz.timezone("America/New_York")
+
+TABLES = {"minute": "candles_minute", "second": "candles_second"}
+
+# Trading days loaded per round trip when streaming a range day by day; one
+# day of second bars is ~23,400 rows, of minute bars ~390.
+STREAM_CHUNK_DAYS = {"second": 1, "minute": 20}
+
+COLUMNS = ["symbol", "ts", "open", "high", "low", "close", "volume", "vwap", "trades"]
+
+def _day_bounds_utc(start, end):
+    # [start 00:00 ET, end+1 00:00 ET) as UTC datetimes, matching the
+    # generated `day` column on the candle tables.
+    lo = US_EASTERN.localize(datetime.combine(start, time()))
+    hi = US_EASTERN.localize(datetime.combine(end + timedelta(days=1), time()))
+    return lo.astimezone(pytz.utc), hi.astimezone(pytz.utc)
+
+def _today_et():
+    return datetime.now(US_EASTERN).date()
+
+def covered_days(engine, symbol, res, start, end):
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "select day from public.candle_coverage "
+            "where symbol = :symbol and resolution = :res and day between :start and :end"
+        ), {"symbol": symbol.upper(), "res": res, "start": start, "end": end}).fetchall()
+    return {r[0] for r in rows}
+
+def day_stats(df):
+    # First/last bar time (epoch ms) and last low of one day's bars; enough
+    # to chain per-day backtests without reading the bars back.
+    if df is None or df.empty:
+        return {"n_rows": 0, "first_ts": None, "last_ts": None, "last_low": None}
+    ts = df['ts'].values.astype('datetime64[ms]').astype('int64')
+    return {"n_rows": len(df), "first_ts": int(ts[0]), "last_ts": int(ts[-1]),
+            "last_low": float(df['low'].iat[-1])}
+
+def mark_covered(engine, symbol, res, day, stats):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "insert into public.candle_coverage (symbol, resolution, day, n_rows, first_ts, last_ts, last_low) "
+            "values (:symbol, :res, :day, :n_rows, :first_ts, :last_ts, :last_low) on conflict do nothing"
+        ), {"symbol": symbol.upper(), "res": res, "day": day, **stats})
+
+def _coverage_res(res):
+    # Coverage rows of derived resolutions only carry the day's stats, so they
+    # are kept apart from rows vouching for stored candles of the same name.
+    return resample.coverage_key(res)
+
+def coverage_stats(engine, symbol, res, start, end):
+    # day -> day_stats() for covered days; rows covered before the stats
+    # columns existed have first_ts null and are left out unless empty.
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "select day, n_rows, first_ts, last_ts, last_low from public.candle_coverage "
+            "where symbol = :symbol and resolution = :res and day between :start and :end"
+        ), {"symbol": symbol.upper(), "res": _coverage_res(res), "start": start, "end": end}).fetchall()
+    return {r[0]: {"n_rows": r[1], "first_ts": r[2], "last_ts": r[3], "last_low": r[4]}
+            for r in rows if r[2] is not None or r[1] == 0}
+
+def backfill_stats(engine, symbol, res, stats_by_day):
+    rows = [{"symbol": symbol.upper(), "res": _coverage_res(res), "day": d, **st} for d, st in stats_by_day.items()]
+    if not rows:
+        return
+    if resample.derived(res):
+        # derived days have no row until their stats are first recorded
+        sql = ("insert into public.candle_coverage (symbol, resolution, day, n_rows, first_ts, last_ts, last_low) "
+               "values (:symbol, :res, :day, :n_rows, :first_ts, :last_ts, :last_low) "
+               "on conflict (symbol, resolution, day) do update set n_rows = excluded.n_rows, "
+               "first_ts = excluded.first_ts, last_ts = excluded.last_ts, last_low = excluded.last_low "
+               "where public.candle_coverage.first_ts is null")
+    else:
+        sql = ("update public.candle_coverage set first_ts = :first_ts, last_ts = :last_ts, last_low = :last_low "
+               "where symbol = :symbol and resolution = :res and day = :day and first_ts is null")
+    with engine.begin() as conn:
+        conn.execute(text(sql), rows)
+
+def read_range(engine, symbol, res, start, end):
+    # One range scan on the (symbol, ts) index for the whole date range.
+    lo, hi = _day_bounds_utc(start, end)
+    sql = text(
+        "select distinct on (ts) symbol, ts, open::float8 as open, high::float8 as high, "
+        "low::float8 as low, close::float8 as close, volume::float8 as volume, vwap::float8 as vwap, trades "
+        f"from public.{TABLES[res]} where symbol = :symbol and ts >= :lo and ts < :hi order by ts"
+    )
+    with metrics.stage("db_read"), engine.connect() as conn:
+        df = pd.read_sql(sql, conn, params={"symbol": symbol.upper(), "lo": lo, "hi": hi})
+    if df.empty:
+        return pd.DataFrame()
+    df['ts'] = pd.to_datetime(df['ts'], utc=True)
+    df['trades'] = df['trades'].astype("Int64")
+    return df[COLUMNS]
+
+def store_days(engine, symbol, res, frames):
+    # Runs on the write-behind thread: rows first, then coverage, so a day is
+    # only marked covered once its candles are committed. Only completed days
+    # are recorded; today's slice may still grow.
+    frames = {d: f for d, f in frames.items() if f is not None}
+    nonempty = [f for f in frames.values() if not f.empty]
+    if nonempty:
+        copy_candles(engine, TABLES[res], pd.concat(nonempty, ignore_index=True))
+    today = _today_et()
+    for d, f in frames.items():
+        if d < today:
+            mark_covered(engine, symbol, res, d, day_stats(f))
+
+def _local_days(symbol, res, days):
+    # day -> frame for the days held in the local bar store.
+    if not bar_store.enabled():
+        return {}
+    out = {}
+    for d in days:
+        cols = bar_store.get_day(symbol, res, d)
+        if cols is not None:
+            out[d] = bar_store.to_frame(symbol, cols)
+    return out
+
+def _keep_local(symbol, res, frames):
+    # Completed days go to the local bar store for the next read.
+    today = _today_et()
+    done = {d: f for d, f in frames.items() if d < today and f is not None}
+    if done and bar_store.enabled():
+        try:
+            bar_store.put_days(symbol, res, done)
+        except OSError:
+            log.exception("bar store write failed")
+
+def _load_derived(engine, symbol, res, days, api_key):
+    # Days of a derived resolution: from the bar store, else resampled from
+    # the level below (ultimately second bars) and kept for the next read.
+    # Today's still-filling last bar is left out.
+    local = _local_days(symbol, res, days)
+    rest = [d for d in days if d not in local]
+    out = dict(local)
+    today = _today_et()
+    bin_ms = resample.RES_MS[res]
+    # a few days of second bars at a time, however long the range
+    for run in chunk_days(rest, STREAM_CHUNK_DAYS["second"]):
+        by_day = split_by_day(load_candles(engine, symbol, resample.PARENT[res], run[0], run[-1], api_key))
+        for d in run:
+            now_ms = int(datetime.now(pytz.utc).timestamp() * 1000) if d == today else None
+            out[d] = resample.resample(by_day.pop(d, None), bin_ms, complete_before_ms=now_ms)
+    _keep_local(symbol, res, {d: out[d] for d in rest})
+    if engine is not None:
+        # stats of the completed days, so per-day backtests find their seeds
+        done = {d: day_stats(out[d]) for d in rest if d < today}
+        if done:
+            writer.submit(backfill_stats, engine, symbol, res, done)
+    frames = [out[d] for d in days if not out[d].empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+def load_candles(engine, symbol, res, start, end, api_key):
+    # Serve days from the local bar store, then fully stored days from
+    # Postgres, and fetch only the remaining trading days from Polygon.
+    # Derived resolutions (see resample.py) are built from second bars.
+    # Fetched days are written behind the response; without a database
+    # every day not held locally is fetched.
+    days = trading_days(start, end)
+    if resample.derived(res):
+        return _load_derived(engine, symbol, res, days, api_key)
+    local = _local_days(symbol, res, days)
+    if engine is None:
+        fetched = fetch_aggs_days(symbol, res, [d for d in days if d not in local], api_key)
+        _keep_local(symbol, res, fetched)
+        frames = [f for d in days for f in (local.get(d), fetched.get(d)) if f is not None and not f.empty]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    have = covered_days(engine, symbol, res, start, end) if len(local) < len(days) else set()
+    missing = [d for d in days if d not in have and d not in local]
+    fetched = fetch_aggs_days(symbol, res, missing, api_key) if missing else {}
+    if fetched:
+        writer.submit(store_days, engine, symbol, res, fetched)
+
+    frames = []
+    from_db = [d for d in days if d in have and d not in local]
+    if from_db:
+        stored = read_range(engine, symbol, res, from_db[0], from_db[-1])
+        if not stored.empty:
+            # only covered days; leftovers of others are replaced by the fetch or the local copy
+            stored_day = stored['ts'].dt.tz_convert(US_EASTERN).dt.date
+            stored = stored[stored_day.isin(set(from_db))]
+        by_day = split_by_day(stored)
+        _keep_local(symbol, res, {d: by_day.get(d, pd.DataFrame()) for d in from_db})
+        frames.append(stored)
+    _keep_local(symbol, res, fetched)
+    frames.extend(f for f in fetched.values() if not f.empty)
+    frames.extend(f for f in local.values() if not f.empty)
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    if len(frames) > 1:
+        df = df.sort_values("ts", kind="stable").reset_index(drop=True)
+    return df
+
+def iter_candle_days(engine, symbol, res, days, api_key, days_per_load=None):
+    # (day, frame) for each of the trading days in order, empty frames for
+    # days without bars, loading a few days at a time through load_candles
+    # so a long range never has to be held at once.
+    days = sorted(days)
+    for run in chunk_days(days, days_per_load or STREAM_CHUNK_DAYS.get(res, 5)):
+        by_day = split_by_day(load_candles(engine, symbol, res, run[0], run[-1], api_key))
+        for d in run:
+            yield d, by_day.pop(d, pd.DataFrame())
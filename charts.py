@@ -0,0 +1,104 @@
+import os
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+
+# Upper bound on candles sent per figure; wider views are re-binned.
+MAX_POINTS = int(os.environ.get("CHART_MAX_POINTS", "1500"))
+
+BIN_LADDER_MS = [1000, 5000, 15000, 30000, 60000, 2*60000, 5*60000, 15*60000, 30*60000, 60*60000]
+
+def pick_bin(span_ms, base_ms):
+    for width in BIN_LADDER_MS:
+        if width >= base_ms and span_ms / width <= MAX_POINTS:
+            return width
+    return BIN_LADDER_MS[-1]
+
+def window(bars, x0=None, x1=None):
+    # Index range of the bars inside [x0, x1] (epoch ms); None means open-ended.
+    ts = bars['ts']
+    i0 = 0 if x0 is None else int(np.searchsorted(ts, x0, side='left'))
+    i1 = len(ts) if x1 is None else int(np.searchsorted(ts, x1, side='right'))
+    return i0, i1
+
+def rebin(bars, bin_ms, i0=0, i1=None):
+    # OHLC of bars[i0:i1] aggregated into bin_ms buckets, keyed by bucket start.
+    i1 = len(bars['ts']) if i1 is None else i1
+    ts = bars['ts'][i0:i1]
+    if len(ts) == 0:
+        return {k: np.empty(0) for k in ("ts", "open", "high", "low", "close")}
+    bucket = ts - ts % bin_ms
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], len(ts)] - 1
+    return {
+        "ts": bucket[starts],
+        "open": bars['open'][i0:i1][starts],
+        "high": np.maximum.reduceat(bars['high'][i0:i1], starts),
+        "low": np.minimum.reduceat(bars['low'][i0:i1], starts),
+        "close": bars['close'][i0:i1][ends],
+    }
+
+def view_bars(bars, base_ms, x0=None, x1=None):
+    # The candles to draw for a view: raw bars when they fit, else re-binned.
+    i0, i1 = window(bars, x0, x1)
+    if i1 - i0 <= MAX_POINTS:
+        return {k: v[i0:i1] for k, v in bars.items()}, base_ms
+    ts = bars['ts']
+    bin_ms = pick_bin(int(ts[i1-1] - ts[i0]), base_ms)
+    return rebin(bars, bin_ms, i0, i1), bin_ms
+
+def candles_trace(view):
+    # x as epoch ms keeps the JSON small; the axis is typed as date.
+    return go.Candlestick(
+        x=np.asarray(view['ts']).tolist(), open=np.asarray(view['open']).tolist(),
+        high=np.asarray(view['high']).tolist(), low=np.asarray(view['low']).tolist(),
+        close=np.asarray(view['close']).tolist(), name="price"
+    )
+
+def marks_trace(marks):
+    # WebGL markers; labels go to hover text rather than rendered text so
+    # dense A0? runs stay cheap to draw.
+    return go.Scattergl(
+        x=[m[0] for m in marks], y=[m[1] for m in marks], text=[m[2] for m in marks],
+        mode="markers", hovertemplate="%{text} %{y}<extra></extra>", name="marks",
+        marker=dict(size=7, symbol="circle-open")
+    )
+
+def figure(bars, marks, base_ms, x0=None, x1=None):
+    view, bin_ms = view_bars(bars, base_ms, x0, x1)
+    if x0 is not None or x1 is not None:
+        marks = [m for m in marks if (x0 is None or m[0] >= x0) and (x1 is None or m[0] <= x1)]
+    fig = go.Figure(data=[candles_trace(view), marks_trace(marks)])
+    fig.update_layout(xaxis_rangeslider_visible=False, uirevision="landing",
+                      xaxis=dict(type="date", range=[x0, x1] if x0 is not None and x1 is not None else None),
+                      title=None if bin_ms == base_ms else f"{bin_ms // 1000}s bins")
+    return fig, bin_ms
+
+def extend_candles(bars, i0):
+    # extendData payload appending bars[i0:] to the candlestick trace.
+    return [{
+        "x": [bars['ts'][i0:].tolist()], "open": [bars['open'][i0:].tolist()],
+        "high": [bars['high'][i0:].tolist()], "low": [bars['low'][i0:].tolist()],
+        "close": [bars['close'][i0:].tolist()]
+    }, [0]]
+
+def extend_marks(marks):
+    return [{
+        "x": [[m[0] for m in marks]], "y": [[m[1] for m in marks]], "text": [[m[2] for m in marks]]
+    }, [1]]
+
+def parse_relayout(relayout):
+    # (x0, x1) in epoch ms from a relayoutData event, (None, None) for
+    # autorange, or False when the event did not touch the x axis.
+    if not relayout:
+        return False
+    if relayout.get("xaxis.autorange"):
+        return None, None
+    if "xaxis.range[0]" in relayout:
+        r = [relayout["xaxis.range[0]"], relayout["xaxis.range[1]"]]
+    elif "xaxis.range" in relayout:
+        r = relayout["xaxis.range"]
+    else:
+        return False
+    x0, x1 = (int(pd.Timestamp(v, tz="UTC").value // 10**6) if isinstance(v, str) else int(v) for v in r)
+    return x0, x1
@@ -0,0 +1,20 @@
+import os
+from sqlalchemy import create_engine
+
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", "5"))
+
+def db_url():
+    url = os.environ.get("SUPABASE_DB_URL")  # postgres connection string
+    if url and "sslmode" not in url:
+        url += ("&" if "?" in url else "?") + "sslmode=require"
+    return url
+
+def make_engine(url=None):
+    # Pooled so SSL sessions are reused across callbacks; pre-ping drops
+    # connections the pooler closed while idle.
+    url = url or db_url()
+    if not url:
+        return None
+    return create_engine(url, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+                         pool_pre_ping=True, pool_recycle=1800)
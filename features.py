@@ -0,0 +1,148 @@
+import hashlib
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+import numpy as np
+
+# Per-bar facts the HL detector needs whatever its parameters, computed once
+# per dataset and shared by every parameter set run over it. Runs that come
+# back to the same day (per-day cached backtests, sweep sets carried across
+# days, successive halving, the batch fallback) go through get_index (via
+# hl_fsm.shared_index), which caches indexes by a fingerprint of the bar
+# arrays; one-off runs (landing chart, universe scans) build a FeatureIndex
+# and drop it.
+#
+# With an index the kernel jumps from one bar that can change its state to
+# the next instead of visiting every bar: see FeatureIndex.next_bar.
+
+# Bars held by cached indexes per process (~170 bytes each, mostly the plain
+# lists the kernel loops over, so ~17MB at the default); a larger dataset is
+# indexed but not kept.
+INDEX_CACHE_BARS = int(float(os.environ.get("FEATURE_INDEX_MAX_BARS", "100000")))
+# First window scanned for the next bar of interest; doubled while empty.
+SCAN_MIN = 64
+# Jumping pays for itself once a pattern time limit spans this many bars;
+# below that (e.g. minute bars) the kernel visits every bar.
+SKIP_MIN_WINDOW_BARS = 120
+
+def fingerprint(ts, low, high, close):
+    h = hashlib.blake2b(digest_size=16)
+    for a in (ts, low, high, close):
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype.str, a.shape)).encode())
+        h.update(a.data)
+    return h.hexdigest()
+
+class FeatureIndex:
+    def __init__(self, ts, low, high, close):
+        self.ts = np.ascontiguousarray(ts, dtype=np.int64)
+        self.low = np.ascontiguousarray(low, dtype=np.float64)
+        self.high = np.ascontiguousarray(high, dtype=np.float64)
+        self.close = np.ascontiguousarray(close, dtype=np.float64)
+        self.n = len(self.ts)
+        # swing[i]: bar i's low is below the previous bar's (bar 0 depends on
+        # the carried state, so it is never marked here)
+        self.swing = np.zeros(self.n, dtype=bool)
+        self.swing[1:] = self.low[1:] < self.low[:-1]
+        self.swing_idx = np.flatnonzero(self.swing).tolist()
+        # typical spacing of the bars, which tells how many of them a time
+        # window spans
+        dt = np.diff(self.ts)
+        self.bar_ms = float(np.median(dt)) if len(dt) else 0.0
+        # the kernel's per-bar loop runs over plain lists
+        self.lists = tuple(a.tolist() for a in (self.ts, self.low, self.high, self.close))
+        self.ts_list = self.lists[0]
+
+    def worth_skipping(self, p):
+        return p['pattern_time_limit_ms'] >= SKIP_MIN_WINDOW_BARS * self.bar_ms
+
+    def _first(self, i, end, hit):
+        # First j in [i, end) where hit(slice) is true, scanning windows that
+        # double in size; end when there is none.
+        size = SCAN_MIN
+        while i < end:
+            e = min(end, i + size)
+            k = np.flatnonzero(hit(slice(i, e)))
+            if len(k):
+                return i + int(k[0])
+            i = e
+            size *= 2
+        return end
+
+    def next_bar(self, i, p, phase, a0, a1, a2, a0_confirmed_at, a1_confirmed_at, start_time,
+                 entry_price, entry_time):
+        # First bar at or after i that can change the FSM state or emit a
+        # mark, given the state before bar i. Bars in between only move
+        # prev_low along, which the kernel takes from low[j-1]. Comparisons
+        # are written exactly as in the kernel so both agree to the bit.
+        n = self.n
+        if i == 0 or i >= n or start_time is None:
+            return i
+        # the time-limit reset at the top of the kernel loop
+        end = bisect_right(self.ts_list, start_time + p['pattern_time_limit_ms'], i)
+        if end <= i:
+            return i
+        low, close, swing = self.low, self.close, self.swing
+
+        if phase == 1:
+            if a0 is None:
+                k = bisect_left(self.swing_idx, i)
+                return min(self.swing_idx[k] if k < len(self.swing_idx) else n, end)
+            a0l = a0[1]
+            thr = a0l + p['price_increase_to_confirm_A0']
+            return self._first(i, end, lambda s: (swing[s] & (low[s] < a0l)) | (close[s] >= thr))
+
+        if phase in (2, 3):
+            confirmed_at = a0_confirmed_at if phase == 2 else a1_confirmed_at
+            wait_end = bisect_left(self.ts_list, confirmed_at + p['time_to_wait_before_confirm_Ax_ms'], i)
+            if wait_end > i:
+                # waiting: only a lower A0 (A1) counts until the wait is over
+                x = (a0 if phase == 2 else a1)[1]
+                return self._first(i, min(wait_end, end), lambda s: low[s] < x)
+            a0l = a0[1]
+            ax = a1 if phase == 2 else a2
+            axl = np.inf if ax is None else ax[1]
+            hi_lim = a0l + p['max_price_increase_above_A0']
+            thr = axl + p['price_increase_to_confirm_higher_low']
+            max_dec = p['max_decrease_below_A0']
+            return self._first(i, end, lambda s: (swing[s] & (low[s] > a0l) & (low[s] <= hi_lim) & (low[s] < axl))
+                               | (close[s] >= thr) | ((a0l - low[s]) > max_dec))
+
+        if phase == 4:
+            a0l = a0[1]
+            thr = a2[1] + p['price_increase_from_A2_to_enter_trade']
+            max_dec = p['max_decrease_below_A0']
+            return self._first(i, end, lambda s: (close[s] <= thr) | ((a0l - low[s]) > max_dec))
+
+        tp = entry_price + p['take_profit_offset']
+        sl = entry_price - p['stop_loss_offset']
+        end = min(end, bisect_left(self.ts_list, entry_time + p['trade_timeout_ms'], i))
+        high = self.high
+        return self._first(i, end, lambda s: (high[s] >= tp) | (low[s] <= sl))
+
+_lock = threading.Lock()
+_cache = OrderedDict()
+_cached_bars = 0
+
+def get_index(ts, low, high, close):
+    # The index for these bars, built on first use.
+    global _cached_bars
+    key = fingerprint(ts, low, high, close)
+    with _lock:
+        index = _cache.get(key)
+        if index is not None:
+            _cache.move_to_end(key)
+            return index
+    index = FeatureIndex(ts, low, high, close)
+    if index.n > INDEX_CACHE_BARS:
+        return index
+    with _lock:
+        if key not in _cache:
+            _cache[key] = index
+            _cached_bars += index.n
+        while _cached_bars > INDEX_CACHE_BARS:
+            _, old = _cache.popitem(last=False)
+            _cached_bars -= old.n
+    return index
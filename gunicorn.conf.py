@@ -0,0 +1,19 @@
+import gc
+import os
+
+import metrics
+
+# Load app.py once in the master so workers share its imports and layouts
+# copy-on-write instead of each importing them after the fork.
+preload_app = True
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+bind = "0.0.0.0:" + os.environ.get("PORT", "8080")
+
+def when_ready(server):
+    # Objects alive now are left out of future collections, so the
+    # collector does not touch (and un-share) their pages in the workers.
+    gc.freeze()
+
+def post_fork(server, worker):
+    # Web workers serve /metrics and write their own snapshots.
+    metrics.export()
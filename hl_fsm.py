@@ -1,7 +1,12 @@
 
 from datetime import datetime
+import time
+import numpy as np
 import pandas as pd
 
+import features
+import metrics
+
 # Default parameters (kept in sync with app.DEFAULT_PARAMS for reuse)
 DEFAULT_PARAMS = {
   "max_price_increase_above_A0": 0.50,
@@ -16,144 +21,481 @@ DEFAULT_PARAMS = {
   "trade_timeout_ms": 45*60*1000
 }
 
-def detect_hl_patterns(df, p):
+def bars_from_df(df):
+    # Contiguous arrays for the kernel: int64 epoch-ms timestamps, float64 prices.
+    ts = df['ts'].values.astype('datetime64[ms]').astype(np.int64)
+    low = np.ascontiguousarray(df['low'].to_numpy(dtype=np.float64))
+    high = np.ascontiguousarray(df['high'].to_numpy(dtype=np.float64))
+    close = np.ascontiguousarray(df['close'].to_numpy(dtype=np.float64))
+    return np.ascontiguousarray(ts), low, high, close
+
+def _ts(ms):
+    return pd.Timestamp(ms, unit='ms', tz='UTC')
+
+def _event(a0, a1, a2, entry_time, entry_price, exit_time, exit_price, outcome, profit):
+    return {
+        "a0_time": _ts(a0[0]), "a0_low": a0[1],
+        "a1_time": _ts(a1[0]) if a1 else None, "a1_low": a1[1] if a1 else None,
+        "a2_time": _ts(a2[0]) if a2 else None, "a2_low": a2[1] if a2 else None,
+        "entry_time": _ts(entry_time), "entry_price": entry_price,
+        "exit_time": _ts(exit_time), "exit_price": exit_price,
+        "outcome": outcome, "profit": profit
+    }
+
+# FSM state carried between runs of the kernel. a0/a1/a2 are (time_ms, low)
+# tuples or None; prev_low is the last bar's low for the swing check.
+STATE_KEYS = ("phase", "a0", "a1", "a2", "a0_confirmed_at", "a1_confirmed_at",
+              "start_time", "entry_price", "entry_time", "prev_low")
+
+# Shorter runs (live refreshes, single bars) skip building a feature index.
+INDEX_MIN_BARS = 2048
+SKIP_MIN_JUMP = 16
+SKIP_MAX_BACKOFF = 64
+
+def shared_index(ts, low, high, close):
+    # The cached feature index of the bars (features.get_index), for callers
+    # that run the same day under many parameter sets or again later; None
+    # when the run is too short to index.
+    return features.get_index(ts, low, high, close) if len(ts) >= INDEX_MIN_BARS else None
+
+def initial_state():
+    return dict(phase=1, a0=None, a1=None, a2=None, a0_confirmed_at=None, a1_confirmed_at=None,
+                start_time=None, entry_price=None, entry_time=None, prev_low=None)
+
+def detect_hl_patterns_arrays(ts, low, high, close, p, collect_marks=True, index=None):
+    events, marks, _ = run_kernel(ts, low, high, close, p, initial_state(), collect_marks, index)
+    return events, marks
+
+def run_kernel(ts, low, high, close, p, state, collect_marks=True, index=None):
+    # Advances the FSM from `state` over the bars; returns the events and
+    # marks produced plus the state after the last bar. Runs of at least
+    # INDEX_MIN_BARS bars use a feature index (features.py), which on dense
+    # enough bars lets the loop jump between the bars that can change the
+    # state. Callers running many sets over the same bars pass a shared one.
+    t0 = time.perf_counter()
+    if index is None and len(ts) >= INDEX_MIN_BARS:
+        index = features.FeatureIndex(ts, low, high, close)
+    next_bar = None
+    if index is not None:
+        ts, low, high, close = index.lists
+        next_bar = index.next_bar if index.worth_skipping(p) else None
+    else:
+        # Plain lists iterate much faster than indexing numpy scalars one by one.
+        ts = np.asarray(ts, dtype=np.int64).tolist()
+        low = np.asarray(low, dtype=np.float64).tolist()
+        high = np.asarray(high, dtype=np.float64).tolist()
+        close = np.asarray(close, dtype=np.float64).tolist()
+
     events = []
     marks = []
+    mark = marks.append if collect_marks else (lambda m: None)
+
+    max_inc = p['max_price_increase_above_A0']
+    confirm_a0 = p['price_increase_to_confirm_A0']
+    max_dec = p['max_decrease_below_A0']
+    confirm_hl = p['price_increase_to_confirm_higher_low']
+    time_limit = p['pattern_time_limit_ms']
+    take_profit = p['take_profit_offset']
+    stop_loss = p['stop_loss_offset']
+    wait_after_confirm = p['time_to_wait_before_confirm_Ax_ms']
+    enter_offset = p['price_increase_from_A2_to_enter_trade']
+    trade_timeout = p['trade_timeout_ms']
+
+    phase = state['phase']
+    a0 = state['a0']; a1 = state['a1']; a2 = state['a2']
+    a0_confirmed_at = state['a0_confirmed_at']; a1_confirmed_at = state['a1_confirmed_at']
+    start_time = state['start_time']
+    entry_price = state['entry_price']; entry_time = state['entry_time']
+    prev_low = state['prev_low']
+    # phase-1 returns by cause, for metrics
+    n_timeout = n_disrupted = n_complete = 0
+
+    n = len(ts)
+    i = -1
+    # Looking ahead costs a few plain bars' worth, so after short jumps the
+    # next look is put off for a growing number of bars.
+    look_at = backoff = 0
+    while True:
+        i += 1
+        if next_bar is not None and i >= look_at:
+            j = next_bar(i, p, phase, a0, a1, a2, a0_confirmed_at, a1_confirmed_at, start_time,
+                         entry_price, entry_time)
+            backoff = 0 if j - i >= SKIP_MIN_JUMP else min(2 * backoff + 1, SKIP_MAX_BACKOFF)
+            look_at = j + 1 + backoff
+            if j != i:
+                i = j
+                prev_low = low[i - 1]
+        if i >= n:
+            break
+        t = ts[i]; lo = low[i]; c = close[i]
+        swing = prev_low is not None and lo < prev_low
+        prev_low = lo
 
-    phase = 1
-    a0 = None; a1 = None; a2 = None
-    a0_confirmed_at = None
-    a1_confirmed_at = None
-    start_time = None
-    in_trade = False
-    entry_price = None
-    entry_time = None
-
-    wait_after_confirm = pd.Timedelta(milliseconds=p['time_to_wait_before_confirm_Ax_ms'])
-    time_limit = pd.Timedelta(milliseconds=p['pattern_time_limit_ms'])
-
-    def reset():
-        nonlocal phase, a0, a1, a2, a0_confirmed_at, a1_confirmed_at, start_time, in_trade, entry_price, entry_time
-        phase = 1
-        a0 = a1 = a2 = None
-        a0_confirmed_at = a1_confirmed_at = None
-        start_time = None
-        in_trade = False
-        entry_price = None
-        entry_time = None
-
-    def disruption(candle_low):
-        if a0 is None: 
-            return False
-        return (a0['low'] - candle_low) > p['max_decrease_below_A0']
-
-    for i, row in df.iterrows():
-        ts = row['ts']; low=row['low']; close=row['close']; high=row['high']
         if start_time is None:
-            start_time = ts
+            start_time = t
 
-        if (ts - start_time) > time_limit:
-            reset()
-            start_time = ts
+        if (t - start_time) > time_limit:
+            if phase != 1:
+                n_timeout += 1
+            phase = 1
+            a0 = a1 = a2 = None
+            a0_confirmed_at = a1_confirmed_at = None
+            entry_price = entry_time = None
+            start_time = t
 
         if phase == 1:
-            if i>0 and low < df.iloc[i-1]['low']:
-                if (a0 is None) or (low < a0['low']):
-                    a0 = dict(time=ts, low=low)
-                    marks.append({"ts": ts, "price": low, "label": "A0?"})
-            if a0 and close >= a0['low'] + p['price_increase_to_confirm_A0']:
-                a0_confirmed_at = ts
+            if swing and (a0 is None or lo < a0[1]):
+                a0 = (t, lo)
+                mark((t, lo, "A0?"))
+            if a0 and c >= a0[1] + confirm_a0:
+                a0_confirmed_at = t
                 phase = 2
-                start_time = ts
-                marks.append({"ts": ts, "price": close, "label": "A0✓"})
-                continue
+                start_time = t
+                mark((t, c, "A0✓"))
 
         elif phase == 2:
-            if (ts - a0_confirmed_at) < wait_after_confirm:
-                if low < a0['low']:
-                    a0 = dict(time=ts, low=low)
-                    marks.append({"ts": ts, "price": low, "label": "A0*"})
+            if (t - a0_confirmed_at) < wait_after_confirm:
+                if lo < a0[1]:
+                    a0 = (t, lo)
+                    mark((t, lo, "A0*"))
                 continue
-            if i>0 and low < df.iloc[i-1]['low']:
-                if (low > a0['low']) and (low <= a0['low'] + p['max_price_increase_above_A0']):
-                    if (a1 is None) or (low < a1['low']):
-                        a1 = dict(time=ts, low=low)
-                        marks.append({"ts": ts, "price": low, "label": "A1?"})
-            if a1 and close >= a1['low'] + p['price_increase_to_confirm_higher_low']:
-                a1_confirmed_at = ts
+            if swing and lo > a0[1] and lo <= a0[1] + max_inc:
+                if a1 is None or lo < a1[1]:
+                    a1 = (t, lo)
+                    mark((t, lo, "A1?"))
+            if a1 and c >= a1[1] + confirm_hl:
+                a1_confirmed_at = t
                 phase = 3
-                start_time = ts
-                marks.append({"ts": ts, "price": close, "label": "A1✓"})
+                start_time = t
+                mark((t, c, "A1✓"))
                 continue
-            if disruption(low):
-                reset(); start_time = ts; continue
+            if (a0[1] - lo) > max_dec:
+                n_disrupted += 1
+                phase = 1
+                a0 = a1 = a2 = None
+                a0_confirmed_at = a1_confirmed_at = None
+                start_time = t
 
         elif phase == 3:
-            if (ts - a1_confirmed_at) < wait_after_confirm:
-                if a1 and low < a1['low']:
-                    a1 = dict(time=ts, low=low)
-                    marks.append({"ts": ts, "price": low, "label": "A1*"})
+            if (t - a1_confirmed_at) < wait_after_confirm:
+                if a1 and lo < a1[1]:
+                    a1 = (t, lo)
+                    mark((t, lo, "A1*"))
                 continue
-            if i>0 and low < df.iloc[i-1]['low']:
-                if (low > a0['low']) and (low <= a0['low'] + p['max_price_increase_above_A0']):
-                    if (a2 is None) or (low < a2['low']):
-                        a2 = dict(time=ts, low=low)
-                        marks.append({"ts": ts, "price": low, "label": "A2?"})
-            if a2 and close >= a2['low'] + p['price_increase_to_confirm_higher_low']:
+            if swing and lo > a0[1] and lo <= a0[1] + max_inc:
+                if a2 is None or lo < a2[1]:
+                    a2 = (t, lo)
+                    mark((t, lo, "A2?"))
+            if a2 and c >= a2[1] + confirm_hl:
                 phase = 4
-                start_time = ts
-                marks.append({"ts": ts, "price": close, "label": "A2✓"})
+                start_time = t
+                mark((t, c, "A2✓"))
                 continue
-            if disruption(low):
-                reset(); start_time = ts; continue
+            if (a0[1] - lo) > max_dec:
+                n_disrupted += 1
+                phase = 1
+                a0 = a1 = a2 = None
+                a0_confirmed_at = a1_confirmed_at = None
+                start_time = t
 
         elif phase == 4:
-            if a2 and close <= (a2['low'] + p['price_increase_from_A2_to_enter_trade']):
-                in_trade = True
-                entry_price = close
-                entry_time = ts
-                marks.append({"ts": ts, "price": close, "label": "BUY"})
+            if a2 and c <= a2[1] + enter_offset:
+                entry_price = c
+                entry_time = t
+                mark((t, c, "BUY"))
                 phase = 5
-                start_time = ts
+                start_time = t
                 continue
-            if disruption(low):
-                reset(); start_time = ts; continue
+            if (a0[1] - lo) > max_dec:
+                n_disrupted += 1
+                phase = 1
+                a0 = a1 = a2 = None
+                a0_confirmed_at = a1_confirmed_at = None
+                start_time = t
 
         elif phase == 5:
-            if in_trade:
-                if row['high'] >= entry_price + p['take_profit_offset']:
-                    events.append({
-                        "a0_time": a0['time'], "a0_low": a0['low'],
-                        "a1_time": a1['time'] if a1 else None, "a1_low": a1['low'] if a1 else None,
-                        "a2_time": a2['time'] if a2 else None, "a2_low": a2['low'] if a2 else None,
-                        "entry_time": entry_time, "entry_price": entry_price,
-                        "exit_time": ts, "exit_price": entry_price + p['take_profit_offset'],
-                        "outcome": "take_profit", "profit": p['take_profit_offset']
-                    })
-                    reset(); start_time = ts; continue
-                if row['low'] <= entry_price - p['stop_loss_offset']:
-                    events.append({
-                        "a0_time": a0['time'], "a0_low": a0['low'],
-                        "a1_time": a1['time'] if a1 else None, "a1_low": a1['low'] if a1 else None,
-                        "a2_time": a2['time'] if a2 else None, "a2_low": a2['low'] if a2 else None,
-                        "entry_time": entry_time, "entry_price": entry_price,
-                        "exit_time": ts, "exit_price": entry_price - p['stop_loss_offset'],
-                        "outcome": "stop_loss", "profit": -p['stop_loss_offset']
-                    })
-                    reset(); start_time = ts; continue
-                if (ts - entry_time) >= pd.Timedelta(milliseconds=p['trade_timeout_ms']):
-                    events.append({
-                        "a0_time": a0['time'], "a0_low": a0['low'],
-                        "a1_time": a1['time'] if a1 else None, "a1_low": a1['low'] if a1 else None,
-                        "a2_time": a2['time'] if a2 else None, "a2_low": a2['low'] if a2 else None,
-                        "entry_time": entry_time, "entry_price": entry_price,
-                        "exit_time": ts, "exit_price": row['close'],
-                        "outcome": "timeout", "profit": row['close'] - entry_price
-                    })
-                    reset(); start_time = ts; continue
+            if high[i] >= entry_price + take_profit:
+                events.append(_event(a0, a1, a2, entry_time, entry_price, t,
+                                     entry_price + take_profit, "take_profit", take_profit))
+            elif lo <= entry_price - stop_loss:
+                events.append(_event(a0, a1, a2, entry_time, entry_price, t,
+                                     entry_price - stop_loss, "stop_loss", -stop_loss))
+            elif (t - entry_time) >= trade_timeout:
+                events.append(_event(a0, a1, a2, entry_time, entry_price, t,
+                                     c, "timeout", c - entry_price))
+            else:
+                continue
+            n_complete += 1
+            phase = 1
+            a0 = a1 = a2 = None
+            a0_confirmed_at = a1_confirmed_at = None
+            entry_price = entry_time = None
+            start_time = t
 
-    return events, marks
+    if collect_marks:
+        marks = [{"ts": _ts(m[0]), "price": m[1], "label": m[2]} for m in marks]
+    state = dict(phase=phase, a0=a0, a1=a1, a2=a2, a0_confirmed_at=a0_confirmed_at,
+                 a1_confirmed_at=a1_confirmed_at, start_time=start_time,
+                 entry_price=entry_price, entry_time=entry_time, prev_low=prev_low)
+    metrics.BARS.inc(len(ts))
+    for reason, n in (("timeout", n_timeout), ("disruption", n_disrupted), ("complete", n_complete)):
+        if n:
+            metrics.FSM_RESETS.inc(n, reason=reason)
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - t0, stage="fsm")
+    return events, marks, state
+
+class HLDetector:
+    # Resumable detect_hl_patterns: feed() advances the FSM over new bars
+    # only, carrying phase/A0-A2/confirmation times/open trade between calls.
+    # Bars at or before the last seen timestamp are ignored, so overlapping
+    # fetches are harmless. Feeding a frame in pieces gives the same events
+    # as one detect_hl_patterns call over the whole frame.
+    def __init__(self, params, collect_marks=True):
+        self.params = dict(params)
+        self.collect_marks = collect_marks
+        self.state = initial_state()
+        self.last_ts = None
+
+    def feed(self, bars):
+        # bars: a candle DataFrame or a (ts_ms, low, high, close) tuple of arrays
+        if isinstance(bars, pd.DataFrame):
+            if bars.empty:
+                return [], []
+            bars = bars_from_df(bars)
+        ts, low, high, close = (np.asarray(a) for a in bars)
+        if self.last_ts is not None:
+            keep = ts > self.last_ts
+            if not keep.all():
+                ts, low, high, close = ts[keep], low[keep], high[keep], close[keep]
+        if len(ts) == 0:
+            return [], []
+        events, marks, self.state = run_kernel(ts, low, high, close, self.params, self.state, self.collect_marks)
+        self.last_ts = int(ts[-1])
+        return events, marks
+
+    def snapshot(self):
+        # JSON-serializable (tuples become lists)
+        state = {k: (list(v) if isinstance(v, tuple) else v) for k, v in self.state.items()}
+        return {"params": self.params, "collect_marks": self.collect_marks,
+                "last_ts": self.last_ts, "state": state}
+
+    @classmethod
+    def restore(cls, snap):
+        det = cls(snap["params"], snap.get("collect_marks", True))
+        det.state = {k: (tuple(v) if isinstance(v, list) else v) for k, v in snap["state"].items()}
+        det.last_ts = snap["last_ts"]
+        return det
+
+PARAM_KEYS = list(DEFAULT_PARAMS.keys())
+
+OUTCOMES = ("take_profit", "stop_loss", "timeout")
+
+def params_matrix(params_list):
+    # One row per parameter set, columns in PARAM_KEYS order.
+    return np.array([[float(p[k]) for k in PARAM_KEYS] for p in params_list], dtype=np.float64).reshape(-1, len(PARAM_KEYS))
+
+def _hl_batch_kernel(ts, low, high, close, pm, seed_low, ev_set, ev_int, ev_float):
+    # One pass over the bars advancing every parameter set (row of pm) with
+    # its own state. Mirrors detect_hl_patterns_arrays; unset A0/A1/A2 lows
+    # are +inf so "None or lower" is a single comparison. Events are written
+    # to the ev_* buffers while they have room; the total count is returned.
+    n_sets = pm.shape[0]
+    inf = np.inf
+    phase = np.ones(n_sets, dtype=np.int64)
+    a0_low = np.full(n_sets, inf); a1_low = np.full(n_sets, inf); a2_low = np.full(n_sets, inf)
+    a0_t = np.zeros(n_sets, dtype=np.int64); a1_t = np.zeros(n_sets, dtype=np.int64); a2_t = np.zeros(n_sets, dtype=np.int64)
+    a0_confirmed_at = np.zeros(n_sets, dtype=np.int64); a1_confirmed_at = np.zeros(n_sets, dtype=np.int64)
+    entry_price = np.zeros(n_sets); entry_time = np.zeros(n_sets, dtype=np.int64)
+    start_time = np.full(n_sets, ts[0], dtype=np.int64)
+    cap = ev_set.shape[0]
+    n_ev = 0
+
+    for i in range(ts.shape[0]):
+        t = ts[i]; lo = low[i]; hi = high[i]; c = close[i]
+        # seed_low: the low of the bar before ts[0] (NaN if none)
+        swing = lo < (low[i-1] if i > 0 else seed_low)
+        for k in range(n_sets):
+            max_inc = pm[k, 0]; confirm_a0 = pm[k, 1]; max_dec = pm[k, 2]; confirm_hl = pm[k, 3]
+            wait_after_confirm = pm[k, 7]
+
+            if (t - start_time[k]) > pm[k, 4]:
+                phase[k] = 1
+                a0_low[k] = inf; a1_low[k] = inf; a2_low[k] = inf
+                start_time[k] = t
+
+            ph = phase[k]
+            reset = False
+            if ph == 1:
+                if swing and lo < a0_low[k]:
+                    a0_low[k] = lo; a0_t[k] = t
+                if c >= a0_low[k] + confirm_a0:
+                    a0_confirmed_at[k] = t; phase[k] = 2; start_time[k] = t
+
+            elif ph == 2:
+                if (t - a0_confirmed_at[k]) < wait_after_confirm:
+                    if lo < a0_low[k]:
+                        a0_low[k] = lo; a0_t[k] = t
+                    continue
+                if swing and lo > a0_low[k] and lo <= a0_low[k] + max_inc and lo < a1_low[k]:
+                    a1_low[k] = lo; a1_t[k] = t
+                if c >= a1_low[k] + confirm_hl:
+                    a1_confirmed_at[k] = t; phase[k] = 3; start_time[k] = t
+                    continue
+                reset = (a0_low[k] - lo) > max_dec
+
+            elif ph == 3:
+                if (t - a1_confirmed_at[k]) < wait_after_confirm:
+                    if lo < a1_low[k]:
+                        a1_low[k] = lo; a1_t[k] = t
+                    continue
+                if swing and lo > a0_low[k] and lo <= a0_low[k] + max_inc and lo < a2_low[k]:
+                    a2_low[k] = lo; a2_t[k] = t
+                if c >= a2_low[k] + confirm_hl:
+                    phase[k] = 4; start_time[k] = t
+                    continue
+                reset = (a0_low[k] - lo) > max_dec
+
+            elif ph == 4:
+                if c <= a2_low[k] + pm[k, 8]:
+                    entry_price[k] = c; entry_time[k] = t; phase[k] = 5; start_time[k] = t
+                    continue
+                reset = (a0_low[k] - lo) > max_dec
+
+            else:
+                outcome = -1
+                if hi >= entry_price[k] + pm[k, 5]:
+                    outcome = 0; exit_price = entry_price[k] + pm[k, 5]; profit = pm[k, 5]
+                elif lo <= entry_price[k] - pm[k, 6]:
+                    outcome = 1; exit_price = entry_price[k] - pm[k, 6]; profit = -pm[k, 6]
+                elif (t - entry_time[k]) >= pm[k, 9]:
+                    outcome = 2; exit_price = c; profit = c - entry_price[k]
+                if outcome >= 0:
+                    if n_ev < cap:
+                        ev_set[n_ev] = k
+                        ev_int[n_ev, 0] = a0_t[k]; ev_int[n_ev, 1] = a1_t[k]; ev_int[n_ev, 2] = a2_t[k]
+                        ev_int[n_ev, 3] = entry_time[k]; ev_int[n_ev, 4] = t; ev_int[n_ev, 5] = outcome
+                        ev_float[n_ev, 0] = a0_low[k]; ev_float[n_ev, 1] = a1_low[k]; ev_float[n_ev, 2] = a2_low[k]
+                        ev_float[n_ev, 3] = entry_price[k]; ev_float[n_ev, 4] = exit_price; ev_float[n_ev, 5] = profit
+                    n_ev += 1
+                    reset = True
+
+            if reset:
+                phase[k] = 1
+                a0_low[k] = inf; a1_low[k] = inf; a2_low[k] = inf
+                start_time[k] = t
+
+    return n_ev
+
+_compiled_batch_kernel = None
+
+def _batch_kernel():
+    # numba is optional and heavy to import, so it is only loaded (and the
+    # kernel compiled) on the first batched run. None means "not available".
+    global _compiled_batch_kernel
+    if _compiled_batch_kernel is None:
+        try:
+            import numba
+            _compiled_batch_kernel = numba.njit(cache=True, nogil=True)(_hl_batch_kernel)
+        except ImportError:
+            _compiled_batch_kernel = False
+    return _compiled_batch_kernel or None
+
+def _run_batch(ts, low, high, close, pm, seed_low=None):
+    # Raw event buffers (set index, int fields, float fields) from the
+    # compiled kernel, or None when numba is not available.
+    kernel = _batch_kernel()
+    if kernel is None:
+        return None
+    ts = np.ascontiguousarray(ts, dtype=np.int64)
+    low = np.ascontiguousarray(low, dtype=np.float64)
+    high = np.ascontiguousarray(high, dtype=np.float64)
+    close = np.ascontiguousarray(close, dtype=np.float64)
+    cap = max(1024, len(ts) // 50)
+    while True:
+        ev_set = np.empty(cap, dtype=np.int64)
+        ev_int = np.empty((cap, 6), dtype=np.int64)
+        ev_float = np.empty((cap, 6), dtype=np.float64)
+        n_ev = kernel(ts, low, high, close, pm, np.nan if seed_low is None else float(seed_low),
+                      ev_set, ev_int, ev_float)
+        if n_ev <= cap:
+            return ev_set[:n_ev], ev_int[:n_ev], ev_float[:n_ev]
+        cap = n_ev
+
+def detect_hl_patterns_batch(ts, low, high, close, pm, seed_low=None):
+    # Evaluate every parameter set (row of pm) in one pass over the bars and
+    # return one events list per set, each equal to what
+    # detect_hl_patterns_arrays produces for that set alone. seed_low is the
+    # low of the bar before the first, as run_kernel's prev_low state.
+    pm = np.ascontiguousarray(pm, dtype=np.float64).reshape(-1, len(PARAM_KEYS))
+    n_sets = len(pm)
+    if n_sets == 0 or len(ts) == 0:
+        return [[] for _ in range(n_sets)]
+
+    raw = _run_batch(ts, low, high, close, pm, seed_low)
+    if raw is None:
+        # one set at a time, all sharing the dataset's feature index
+        index = shared_index(ts, low, high, close)
+        return [run_kernel(ts, low, high, close, dict(zip(PARAM_KEYS, row)), dict(initial_state(), prev_low=seed_low),
+                           collect_marks=False, index=index)[0]
+                for row in pm.tolist()]
+
+    ev_set, ev_int, ev_float = raw
+    events = [[] for _ in range(n_sets)]
+    for k, ti, fl in zip(ev_set.tolist(), ev_int.tolist(), ev_float.tolist()):
+        events[k].append(_event((ti[0], fl[0]), (ti[1], fl[1]), (ti[2], fl[2]),
+                                ti[3], fl[3], ti[4], fl[4], OUTCOMES[ti[5]], fl[5]))
+    return events
+
+def batch_metrics(ts, low, high, close, pm, seed_low=None):
+    # Per-set summarize_events() results without materializing event dicts,
+    # which dominate the cost of large sweeps.
+    pm = np.ascontiguousarray(pm, dtype=np.float64).reshape(-1, len(PARAM_KEYS))
+    n_sets = len(pm)
+    raw = _run_batch(ts, low, high, close, pm, seed_low) if n_sets and len(ts) else None
+    if raw is None:
+        return [summarize_events(ev) for ev in detect_hl_patterns_batch(ts, low, high, close, pm, seed_low)]
+
+    ev_set, ev_int, ev_float = raw
+    patterns = np.bincount(ev_set, minlength=n_sets)
+    wins = np.bincount(ev_set, weights=(ev_int[:, 5] == 0), minlength=n_sets)
+    profit = np.bincount(ev_set, weights=ev_float[:, 5], minlength=n_sets)
+    out = []
+    for total, w, pl in zip(patterns.tolist(), wins.tolist(), profit.tolist()):
+        out.append({
+            "patterns": total,
+            "win_rate_pct": (w/total*100) if total else 0.0,
+            "avg_profit": (pl/total) if total else 0.0
+        })
+    return out
+
+def detect_hl_patterns(df, p, collect_marks=True):
+    if df is None or df.empty:
+        return [], []
+    ts, low, high, close = bars_from_df(df)
+    return detect_hl_patterns_arrays(ts, low, high, close, p, collect_marks=collect_marks)
 
 def run_backtest_on_df(df, params):
-    events, _ = detect_hl_patterns(df, params)
+    events, _ = detect_hl_patterns(df, params, collect_marks=False)
     return events
+
+def run_stream(frames, params, state=None):
+    # Runs the FSM over frames in order as over their concatenation, carrying
+    # the state across frame boundaries, so only one frame (e.g. a day) has
+    # to be in memory. Returns the events and the state after the last bar.
+    state = state or initial_state()
+    events = []
+    for df in frames:
+        if df is None or df.empty:
+            continue
+        ev, _, state = run_kernel(*bars_from_df(df), params, state, collect_marks=False)
+        events.extend(ev)
+    return events, state
+
+def summarize_events(events):
+    total = len(events)
+    wins = sum(1 for o in events if o.get('outcome') == 'take_profit')
+    return {
+        "patterns": total,
+        "win_rate_pct": (wins/total*100) if total else 0.0,
+        "avg_profit": float(np.mean([o.get('profit',0) for o in events])) if events else 0.0
+    }
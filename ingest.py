@@ -0,0 +1,72 @@
+import io
+import logging
+import queue
+import threading
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+CANDLE_COLUMNS = ["symbol", "ts", "open", "high", "low", "close", "volume", "vwap", "trades"]
+
+def copy_candles(engine, table, df):
+    # COPY into a temp staging table, then merge; reruns and overlapping
+    # fetches are absorbed by the unique (symbol, ts) index.
+    if df is None or df.empty:
+        return 0
+    buf = io.StringIO()
+    df[CANDLE_COLUMNS].to_csv(buf, header=False, index=False, date_format="%Y-%m-%dT%H:%M:%S.%f%z")
+    buf.seek(0)
+    cols = ", ".join(CANDLE_COLUMNS)
+    raw = engine.raw_connection()
+    try:
+        cur = raw.cursor()
+        cur.execute(
+            "create temp table if not exists _stage_candles ("
+            "symbol text, ts timestamptz, open float8, high float8, low float8, close float8, "
+            "volume float8, vwap float8, trades bigint) on commit delete rows"
+        )
+        cur.copy_expert(f"copy _stage_candles ({cols}) from stdin with (format csv)", buf)
+        cur.execute(
+            f"insert into public.{table} ({cols}) select {cols} from _stage_candles "
+            "on conflict (symbol, ts) do nothing"
+        )
+        inserted = cur.rowcount
+        raw.commit()
+        return inserted
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+class WriteBehind:
+    # Single background thread that runs queued database writes in order,
+    # so request handlers return without waiting on the database.
+    def __init__(self, maxsize=256):
+        self.q = queue.Queue(maxsize=maxsize)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _run(self):
+        while True:
+            fn, args = self.q.get()
+            try:
+                with metrics.stage("db_write"):
+                    fn(*args)
+            except Exception:
+                log.exception("write-behind job %s failed", getattr(fn, "__name__", fn))
+            finally:
+                self.q.task_done()
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self.thread.start()
+        self.q.put((fn, args))
+
+    def flush(self):
+        self.q.join()
+
+writer = WriteBehind()
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Long backtests and sweeps run here instead of in a web request. The queue
+# is a sqlite file on local disk shared by the web processes and the job
+# workers; every call opens its own connection so it is safe across forks.
+JOBS_DB = os.environ.get("JOBS_DB", os.path.join(tempfile.gettempdir(), "hl_jobs.sqlite3"))
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+
+HEARTBEAT_SECONDS = 5
+# A running job whose worker has not checked in for this long is requeued.
+STALE_SECONDS = 60
+MAX_ATTEMPTS = 3
+# Finished jobs are kept this long for the UI to pick up their results.
+KEEP_SECONDS = 24 * 3600
+
+ACTIVE = ("queued", "running")
+
+class JobCancelled(Exception):
+    pass
+
+def _connect():
+    conn = sqlite3.connect(JOBS_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("pragma journal_mode=wal")
+    conn.execute(
+        "create table if not exists jobs ("
+        " id text primary key, kind text not null, key text not null, args text not null,"
+        " status text not null, done integer default 0, total integer default 0, note text,"
+        " cancel integer default 0, result text, error text, attempts integer default 0,"
+        " created_at real, updated_at real, heartbeat_at real)"
+    )
+    conn.execute("create index if not exists jobs_key on jobs(key, status)")
+    conn.execute("create index if not exists jobs_status on jobs(status, created_at)")
+    return conn
+
+def job_key(kind, args):
+    return hashlib.sha1(json.dumps([kind, args], sort_keys=True).encode()).hexdigest()
+
+def submit(kind, args):
+    # Returns the id of an identical queued/running job if there is one.
+    key = job_key(kind, args)
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("begin immediate")
+        row = conn.execute(
+            "select id from jobs where key = ? and status in (?, ?) and cancel = 0", (key,) + ACTIVE
+        ).fetchone()
+        if row:
+            conn.execute("commit")
+            return row["id"]
+        job_id = uuid.uuid4().hex
+        conn.execute(
+            "insert into jobs (id, kind, key, args, status, created_at, updated_at) values (?, ?, ?, ?, 'queued', ?, ?)",
+            (job_id, kind, key, json.dumps(args), now, now)
+        )
+        conn.execute("delete from jobs where status not in (?, ?) and updated_at < ?", ACTIVE + (now - KEEP_SECONDS,))
+        conn.execute("commit")
+        return job_id
+    finally:
+        conn.close()
+
+def get(job_id):
+    conn = _connect()
+    try:
+        row = conn.execute("select * from jobs where id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    job = dict(row)
+    job["args"] = json.loads(job["args"])
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+def cancel(job_id):
+    # Queued jobs are dropped at once; running ones stop at their next
+    # progress report.
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("update jobs set status = 'cancelled', updated_at = ? where id = ? and status = 'queued'", (now, job_id))
+        conn.execute("update jobs set cancel = 1, updated_at = ? where id = ? and status = 'running'", (now, job_id))
+    finally:
+        conn.close()
+
+def claim():
+    # Oldest queued job, or a running one whose worker went silent.
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("begin immediate")
+        while True:
+            row = conn.execute(
+                "select * from jobs where status = 'queued' or (status = 'running' and heartbeat_at < ?) "
+                "order by created_at limit 1", (now - STALE_SECONDS,)
+            ).fetchone()
+            if row is None:
+                conn.execute("commit")
+                return None
+            if row["attempts"] < MAX_ATTEMPTS:
+                break
+            conn.execute("update jobs set status = 'failed', error = 'worker lost', updated_at = ? where id = ?",
+                         (now, row["id"]))
+        conn.execute(
+            "update jobs set status = 'running', attempts = attempts + 1, heartbeat_at = ?, updated_at = ? where id = ?",
+            (now, now, row["id"])
+        )
+        conn.execute("commit")
+        return dict(row, args=json.loads(row["args"]))
+    finally:
+        conn.close()
+
+def report(job_id, done, total, note=None):
+    # Records progress; raises JobCancelled once a cancel was requested.
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "update jobs set done = ?, total = ?, note = ?, heartbeat_at = ?, updated_at = ? where id = ?",
+            (done, total, note, now, now, job_id)
+        )
+        row = conn.execute("select cancel from jobs where id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if row and row["cancel"]:
+        raise JobCancelled(job_id)
+
+def _heartbeat(job_id):
+    conn = _connect()
+    try:
+        conn.execute("update jobs set heartbeat_at = ? where id = ? and status = 'running'", (time.time(), job_id))
+    finally:
+        conn.close()
+
+def _finish(job_id, status, result=None, error=None):
+    conn = _connect()
+    try:
+        conn.execute(
+            "update jobs set status = ?, result = ?, error = ?, updated_at = ? where id = ?",
+            (status, json.dumps(result, default=_json_default) if result is not None else None, error, time.time(), job_id)
+        )
+    finally:
+        conn.close()
+
+def _json_default(o):
+    # numpy scalars from pandas aggregations
+    return o.item() if hasattr(o, "item") else str(o)
+
+def run_job(job):
+    import tasks
+    handler = tasks.HANDLERS[job["kind"]]
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(HEARTBEAT_SECONDS):
+            try:
+                _heartbeat(job["id"])
+            except sqlite3.Error:
+                log.exception("heartbeat for job %s failed", job["id"])
+
+    t = threading.Thread(target=beat, daemon=True)
+    t.start()
+    t0 = time.perf_counter()
+    status = "failed"
+    try:
+        with metrics.profiled(f"job-{job['kind']}"):
+            result = handler(job["args"], lambda done, total, note=None: report(job["id"], done, total, note))
+        status = "done"
+        _finish(job["id"], "done", result=result)
+    except JobCancelled:
+        status = "cancelled"
+        _finish(job["id"], "cancelled")
+    except Exception as e:
+        log.exception("job %s failed", job["id"])
+        _finish(job["id"], "failed", error="".join(traceback.format_exception_only(type(e), e)).strip())
+    finally:
+        stop.set()
+        t.join()
+        metrics.JOB_SECONDS.observe(time.perf_counter() - t0, kind=job["kind"], status=status)
+        metrics.flush()
+
+def work_forever(poll_seconds=1.0):
+    # A failed claim or a job whose failure could not be recorded (e.g. the
+    # queue was locked) is logged and the loop goes on; such a job is
+    # requeued once its heartbeat goes stale.
+    while True:
+        try:
+            job = claim()
+            if job is None:
+                time.sleep(poll_seconds)
+                continue
+            run_job(job)
+        except Exception:
+            log.exception("job worker error")
+            time.sleep(poll_seconds)
+
+def _start_worker():
+    p = multiprocessing.Process(target=work_forever)
+    p.start()
+    return p
+
+def start_workers(n=None):
+    # Job worker processes; each claims one job at a time. Not daemonic,
+    # since sweeps start their own process pools.
+    return [_start_worker() for _ in range(n or JOB_WORKERS)]
+
+def supervise(procs, check_seconds=HEARTBEAT_SECONDS):
+    # Replaces workers that died (killed for memory, crashed) so the queue
+    # never runs dry of them; their jobs are requeued by the stale check.
+    while True:
+        time.sleep(check_seconds)
+        for i, p in enumerate(procs):
+            if not p.is_alive():
+                log.warning("job worker %s exited with %s; restarting", p.pid, p.exitcode)
+                procs[i] = _start_worker()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+    # imported once here and shared copy-on-write by the forked workers
+    import tasks
+    metrics.export()
+    supervise(start_workers())
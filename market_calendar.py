@@ -0,0 +1,85 @@
+from datetime import date, timedelta
+from functools import lru_cache
+
+# NYSE full-day holidays computed from the exchange's rules. Unscheduled
+# closures (national days of mourning, weather) are not covered.
+
+def _nth_weekday(year, month, weekday, n):
+    d = date(year, month, 1)
+    d += timedelta(days=(weekday - d.weekday()) % 7)
+    return d + timedelta(weeks=n - 1)
+
+def _last_weekday(year, month, weekday):
+    d = date(year, month + 1, 1) - timedelta(days=1) if month < 12 else date(year, 12, 31)
+    return d - timedelta(days=(d.weekday() - weekday) % 7)
+
+def _easter(year):
+    # Anonymous Gregorian algorithm
+    a = year % 19; b = year // 100; c = year % 100
+    d = b // 4; e = b % 4; f = (b + 8) // 25; g = (b - f + 1) // 3
+    h = (19*a + b - d - g + 15) % 30
+    i = c // 4; k = c % 4
+    l = (32 + 2*e + 2*i - h - k) % 7
+    m = (a + 11*h + 22*l) // 451
+    month = (h + l - 7*m + 114) // 31
+    day = ((h + l - 7*m + 114) % 31) + 1
+    return date(year, month, day)
+
+def _observed(d):
+    if d.weekday() == 5:
+        return d - timedelta(days=1)
+    if d.weekday() == 6:
+        return d + timedelta(days=1)
+    return d
+
+@lru_cache(maxsize=None)
+def nyse_holidays(year):
+    days = set()
+    new_year = date(year, 1, 1)
+    if new_year.weekday() != 5:  # a Saturday New Year's Day is not observed
+        days.add(_observed(new_year))
+    days.add(_nth_weekday(year, 1, 0, 3))   # Martin Luther King Jr. Day
+    days.add(_nth_weekday(year, 2, 0, 3))   # Washington's Birthday
+    days.add(_easter(year) - timedelta(days=2))  # Good Friday
+    days.add(_last_weekday(year, 5, 0))     # Memorial Day
+    if year >= 2022:
+        days.add(_observed(date(year, 6, 19)))  # Juneteenth
+    days.add(_observed(date(year, 7, 4)))
+    days.add(_nth_weekday(year, 9, 0, 1))   # Labor Day
+    days.add(_nth_weekday(year, 11, 3, 4))  # Thanksgiving
+    days.add(_observed(date(year, 12, 25)))
+    return frozenset(days)
+
+def is_trading_day(d):
+    return d.weekday() < 5 and d not in nyse_holidays(d.year)
+
+def trading_days(start, end):
+    out = []
+    d = start
+    while d <= end:
+        if is_trading_day(d):
+            out.append(d)
+        d += timedelta(days=1)
+    return out
+
+def previous_trading_day(d):
+    while not is_trading_day(d):
+        d -= timedelta(days=1)
+    return d
+
+def next_trading_day(d):
+    d += timedelta(days=1)
+    while not is_trading_day(d):
+        d += timedelta(days=1)
+    return d
+
+def chunk_days(days, max_days):
+    # Runs of at most max_days sorted trading days with no trading day missing
+    # in between; each run can be fetched as one start/end range.
+    chunks = []
+    for d in days:
+        if chunks and len(chunks[-1]) < max_days and next_trading_day(chunks[-1][-1]) == d:
+            chunks[-1].append(d)
+        else:
+            chunks.append([d])
+    return chunks
@@ -0,0 +1,245 @@
+import cProfile
+import functools
+import glob
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Counters and histograms in Prometheus text format. Web workers, job
+# workers and the live scanner are separate processes, so each one that
+# calls export() writes a snapshot of its metrics to METRICS_DIR every few
+# seconds, and /metrics serves them all, one series per process under a
+# `process` label (pid plus start time, so a reused pid starts a new series).
+# Other processes (tests, benchmarks, replays) record but never write.
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "hl_metrics"))
+FLUSH_SECONDS = 10
+# Snapshots of processes gone this long are dropped; their series just end.
+KEEP_SECONDS = 24 * 3600
+
+# Opt-in profiling: with PROFILE_SLOW_MS set, requests and jobs are run under
+# cProfile one at a time, and the first PROFILE_DUMPS of them slower than the
+# threshold are dumped to PROFILE_DIR for `python -m pstats`.
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "0"))
+PROFILE_DUMPS = int(os.environ.get("PROFILE_DUMPS", "1"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", tempfile.gettempdir())
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_registry = {}
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        _registry[name] = self
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[k]) for k in self.labelnames)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        _flusher.ensure()
+
+    def snapshot(self):
+        return {"type": "counter", "help": self.help, "labels": self.labelnames,
+                "values": [[list(k), v] for k, v in self.values.items()]}
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self.values = {}
+        _registry[name] = self
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[k]) for k in self.labelnames)
+        i = next((j for j, b in enumerate(self.buckets) if value <= b), len(self.buckets))
+        with _lock:
+            row = self.values.get(key)
+            if row is None:
+                row = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[i] += 1
+            row[-1] += value
+        _flusher.ensure()
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def snapshot(self):
+        return {"type": "histogram", "help": self.help, "labels": self.labelnames, "buckets": self.buckets,
+                "values": [[list(k), list(v)] for k, v in self.values.items()]}
+
+STAGE_SECONDS = Histogram("hl_stage_seconds", "Time spent per pipeline stage.", ["stage"])
+CALLBACK_SECONDS = Histogram("hl_callback_seconds", "Dash callback latency.", ["callback"])
+JOB_SECONDS = Histogram("hl_job_seconds", "Background job run time.", ["kind", "status"])
+POLYGON_PAGES = Counter("hl_polygon_pages_total", "Polygon aggregate pages received.")
+POLYGON_ERRORS = Counter("hl_polygon_errors_total", "Failed Polygon requests, including retried ones.", ["error"])
+BARS = Counter("hl_bars_processed_total", "Bars run through the HL detector.")
+FSM_RESETS = Counter("hl_fsm_resets_total", "HL detector returns to phase 1.", ["reason"])
+SCANNER_SIGNALS = Counter("hl_scanner_signals_total", "Signals pushed by the live scanner.", ["kind"])
+SIGNAL_LATENCY = Histogram("hl_scanner_signal_latency_seconds",
+                           "Time from a bar reaching the scanner to its signal being pushed.")
+
+def stage(name):
+    # with metrics.stage("fsm"): ...
+    return STAGE_SECONDS.time(stage=name)
+
+def timed_callback(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with CALLBACK_SECONDS.time(callback=fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+def snapshot():
+    with _lock:
+        return {name: m.snapshot() for name, m in _registry.items()}
+
+def _merge(into, snap):
+    for name, m in snap.items():
+        cur = into.setdefault(name, dict(m, values={}))
+        for labels, v in m["values"]:
+            key = tuple(labels)
+            if m["type"] == "counter":
+                cur["values"][key] = cur["values"].get(key, 0) + v
+            else:
+                old = cur["values"].get(key)
+                cur["values"][key] = [a + b for a, b in zip(old, v)] if old else list(v)
+
+def _label_str(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    esc = lambda s: str(s).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+def render(merged):
+    lines = []
+    for name in sorted(merged):
+        m = merged[name]
+        lines.append(f"# HELP {name} {m['help']}")
+        lines.append(f"# TYPE {name} {m['type']}")
+        for key, v in sorted(m["values"].items()):
+            if m["type"] == "counter":
+                lines.append(f"{name}{_label_str(m['labels'], key)} {v}")
+                continue
+            cum = 0
+            for b, n in zip(list(m["buckets"]) + ["+Inf"], v[:-1]):
+                cum += n
+                lines.append(f"{name}_bucket{_label_str(m['labels'], key, [('le', b)])} {cum}")
+            lines.append(f"{name}_sum{_label_str(m['labels'], key)} {v[-1]}")
+            lines.append(f"{name}_count{_label_str(m['labels'], key)} {cum}")
+    return "\n".join(lines) + "\n"
+
+def export():
+    # Makes this process (and children forked from it) write snapshots.
+    _flusher.exporting = True
+
+def flush():
+    if not _flusher.exporting:
+        return
+    _flusher.ensure()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, _flusher.process + ".json")
+    fd, tmp = tempfile.mkstemp(dir=METRICS_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp, path)
+
+def _labelled(snap, process):
+    # The snapshot with every series tagged by the process that wrote it.
+    return {name: dict(m, labels=list(m["labels"]) + ["process"],
+                       values=[[list(labels) + [process], v] for labels, v in m["values"]])
+            for name, m in snap.items()}
+
+def collect():
+    # Prometheus text for all processes sharing METRICS_DIR.
+    flush()
+    merged = {}
+    now = time.time()
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        try:
+            if now - os.path.getmtime(path) > KEEP_SECONDS:
+                os.remove(path)
+                continue
+            with open(path) as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            continue
+        _merge(merged, _labelled(snap, os.path.basename(path)[:-len(".json")]))
+    return render(merged)
+
+class _Flusher:
+    # Writes this process's snapshot every FLUSH_SECONDS once anything was
+    # recorded, if it exports. Restarted after a fork, since threads do not
+    # survive it.
+    def __init__(self):
+        self.exporting = False
+        self.pid = None
+        self.process = None
+
+    def ensure(self):
+        if not self.exporting or self.pid == os.getpid():
+            return
+        with _lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.process = f"{self.pid}-{int(time.time())}"
+            threading.Thread(target=self._run, name="metrics-flush", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(FLUSH_SECONDS)
+            try:
+                flush()
+            except OSError:
+                log.exception("metrics flush failed")
+
+_flusher = _Flusher()
+
+_profile_lock = threading.Lock()
+_profile_dumps = 0
+
+@contextmanager
+def profiled(name):
+    # Profiles the block when PROFILE_SLOW_MS is set and no other block is
+    # being profiled; dumps the stats if it ran longer than the threshold.
+    global _profile_dumps
+    if not PROFILE_SLOW_MS or _profile_dumps >= PROFILE_DUMPS or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    prof = cProfile.Profile()
+    t0 = time.perf_counter()
+    try:
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+        ms = (time.perf_counter() - t0) * 1000
+        if ms >= PROFILE_SLOW_MS and _profile_dumps < PROFILE_DUMPS:
+            _profile_dumps += 1
+            slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_") or "request"
+            path = os.path.join(PROFILE_DIR, f"hl-profile-{slug}-{int(time.time())}-{os.getpid()}.prof")
+            prof.dump_stats(path)
+            log.warning("%s took %.0f ms; profile written to %s", name, ms, path)
+    finally:
+        _profile_lock.release()
@@ -1,39 +1,179 @@
-
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 import requests
+from requests.adapters import HTTPAdapter
+import numpy as np
 import pandas as pd
+import pytz
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+
+import metrics
+from market_calendar import chunk_days, is_trading_day
+
+API_ROOT = os.environ.get("POLYGON_API_ROOT", "https://api.polygon.io")
+BASE = API_ROOT + "/v2/aggs/ticker/{symbol}/range/{mult}/{res}/{start}/{end}"
+
+MAX_WORKERS = int(os.environ.get("POLYGON_MAX_WORKERS", "8"))
+MAX_RPS = float(os.environ.get("POLYGON_MAX_RPS", "20"))
+
+# Trading days per request; a day is at most ~960 minute bars or ~57,600
+# second bars, and longer ranges are paged through next_url anyway.
+CHUNK_DAYS = {"minute": 40, "second": 2}
+
+US_EASTERN = pytz.timezone("America/New_York")
+
+class PolygonError(RuntimeError):
+    def __init__(self, status, body, retry_after=None):
+        super().__init__(f"Polygon error {status}: {body}")
+        self.status = status
+        self.retry_after = retry_after
+
+class TokenBucket:
+    # Allows `rate` requests per second on average with bursts up to `capacity`.
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+limiter = TokenBucket(MAX_RPS)
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    # One keep-alive connection pool shared by all fetch threads.
+    global _session
+    with _session_lock:
+        if _session is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS * 2)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            _session = s
+    return _session
 
-BASE = "https://api.polygon.io/v2/aggs/ticker/{symbol}/range/{mult}/{res}/{start}/{end}"
+def _retryable(exc):
+    if isinstance(exc, PolygonError):
+        return exc.status == 429 or exc.status >= 500
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+def _wait(retry_state):
+    # Honour Retry-After on 429s, otherwise back off exponentially.
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, PolygonError) and exc.retry_after is not None:
+        return exc.retry_after
+    return wait_exponential(multiplier=0.5, max=30)(retry_state)
+
+@retry(retry=retry_if_exception(_retryable), wait=_wait, stop=stop_after_attempt(6), reraise=True)
+def _get_page(url, params):
+    limiter.acquire()
+    try:
+        rq = get_session().get(url, params=params, timeout=30)
+    except requests.RequestException as e:
+        metrics.POLYGON_ERRORS.inc(error=type(e).__name__)
+        raise
+    if rq.status_code != 200:
+        metrics.POLYGON_ERRORS.inc(error=rq.status_code)
+        retry_after = rq.headers.get("Retry-After")
+        raise PolygonError(rq.status_code, rq.text,
+                           float(retry_after) if retry_after and retry_after.isdigit() else None)
+    metrics.POLYGON_PAGES.inc()
+    return rq.json()
 
 def _iso(d):
     if isinstance(d, date):
         return d.isoformat()
     return d
 
-def fetch_aggs_range(symbol, mult, res, start, end, api_key):
+COLUMNS = ["symbol", "ts", "open", "high", "low", "close", "volume", "vwap", "trades"]
+
+def decode_page(results, symbol):
+    # Build typed columns straight from the JSON results, with a single
+    # vectorized timestamp conversion per page.
+    n = len(results)
+    t = np.fromiter((r["t"] for r in results), dtype=np.int64, count=n)
+    cols = {
+        "symbol": np.full(n, symbol.upper(), dtype=object),
+        "ts": pd.to_datetime(t, unit="ms", utc=True),
+        "open": np.fromiter((r["o"] for r in results), dtype=np.float64, count=n),
+        "high": np.fromiter((r["h"] for r in results), dtype=np.float64, count=n),
+        "low": np.fromiter((r["l"] for r in results), dtype=np.float64, count=n),
+        "close": np.fromiter((r["c"] for r in results), dtype=np.float64, count=n),
+        "volume": np.fromiter((r.get("v", np.nan) for r in results), dtype=np.float64, count=n),
+        "vwap": np.fromiter((r.get("vw", np.nan) for r in results), dtype=np.float64, count=n),
+        "trades": pd.array([r.get("n") for r in results], dtype="Int64"),
+    }
+    return pd.DataFrame(cols, columns=COLUMNS)
+
+def iter_aggs_pages(symbol, mult, res, start, end, api_key):
+    # Yields one DataFrame per API page as it arrives.
     if not api_key:
         raise RuntimeError("Missing POLYGON_API_KEY")
     url = BASE.format(symbol=symbol.upper(), mult=mult, res=res, start=_iso(start), end=_iso(end))
     params = {"adjusted":"true", "sort":"asc", "limit":50000, "apiKey": api_key}
-    out = []
     next_url = None
     while True:
-        rq = requests.get(next_url or url, params=None if next_url else params, timeout=30)
-        if rq.status_code != 200:
-            raise RuntimeError(f"Polygon error {rq.status_code}: {rq.text}")
-        data = rq.json()
+        # next_url carries the cursor but not the key
+        data = _get_page(next_url or url, {"apiKey": api_key} if next_url else params)
         results = data.get("results", [])
-        for r in results:
-            out.append({
-                "symbol": symbol.upper(),
-                "ts": pd.to_datetime(r["t"], unit="ms", utc=True),
-                "open": r["o"], "high": r["h"], "low": r["l"], "close": r["c"],
-                "volume": r.get("v"), "vwap": r.get("vw"), "trades": r.get("n")
-            })
+        if results:
+            yield decode_page(results, symbol)
         next_url = data.get("next_url")
         if not next_url:
             break
-    if not out:
+
+def fetch_aggs_range(symbol, mult, res, start, end, api_key):
+    with metrics.stage("polygon_fetch"):
+        pages = list(iter_aggs_pages(symbol, mult, res, start, end, api_key))
+    if not pages:
         return pd.DataFrame()
-    df = pd.DataFrame(out).sort_values("ts").reset_index(drop=True)
+    df = pd.concat(pages, ignore_index=True) if len(pages) > 1 else pages[0]
+    # sort=asc is requested, so only re-sort if the API broke that promise
+    if not df['ts'].is_monotonic_increasing:
+        df = df.sort_values("ts", kind="stable").reset_index(drop=True)
     return df
+
+def split_by_day(df):
+    # Per-ET-day frames, matching the `day` column on the candle tables.
+    if df is None or df.empty:
+        return {}
+    day = df['ts'].dt.tz_convert(US_EASTERN).dt.date
+    return {d: g.reset_index(drop=True) for d, g in df.groupby(day, sort=True)}
+
+def fetch_aggs_days(symbol, res, days, api_key, max_workers=None):
+    # Fetch the given days as multi-day ranges in parallel. Non-trading days
+    # are never requested; every requested trading day gets an entry, empty
+    # when Polygon has no bars for it.
+    days = sorted(d for d in set(days) if is_trading_day(d))
+    chunks = chunk_days(days, CHUNK_DAYS.get(res, 1))
+    out = {d: pd.DataFrame() for d in days}
+    if not chunks:
+        return out
+
+    def fetch(chunk):
+        return chunk, fetch_aggs_range(symbol, 1, res, chunk[0], chunk[-1], api_key)
+
+    with ThreadPoolExecutor(max_workers=min(len(chunks), max_workers or MAX_WORKERS)) as pool:
+        for chunk, df in pool.map(fetch, chunks):
+            wanted = set(chunk)
+            for d, g in split_by_day(df).items():
+                if d in wanted:
+                    out[d] = g
+    return out
@@ -0,0 +1,87 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from polygon_client import fetch_aggs_range
+
+# Coarser bars built from finer ones in-process, so a symbol/day needs one
+# upstream fetch at second resolution whatever resolution is shown. Each
+# level is derived from the one below it (second -> minute -> 5minute ...),
+# which is exact for OHLC, volume, trade counts and volume-weighted vwap.
+
+RES_MS = {"second": 1000, "minute": 60_000, "5minute": 5 * 60_000, "15minute": 15 * 60_000,
+          "hour": 60 * 60_000}
+PARENT = {"minute": "second", "5minute": "minute", "15minute": "5minute", "hour": "15minute"}
+
+# Set to 0 to fetch minute aggregates from Polygon as before.
+DERIVE_FROM_SECONDS = os.environ.get("DERIVE_FROM_SECONDS", "1") != "0"
+
+COLUMNS = ["symbol", "ts", "open", "high", "low", "close", "volume", "vwap", "trades"]
+
+def derived(res):
+    # True when res is built from second bars rather than fetched.
+    return DERIVE_FROM_SECONDS and res in PARENT
+
+def coverage_key(res):
+    # candle_coverage resolution under which a day's stats are kept.
+    return res + "_derived" if derived(res) else res
+
+def resample(df, bin_ms, complete_before_ms=None):
+    # OHLCV/vwap bars of bin_ms from finer, ts-sorted bars; each bar is keyed
+    # by its bucket start. With complete_before_ms, a last bucket that ends
+    # after it (still filling) is dropped.
+    if df is None or df.empty:
+        return pd.DataFrame()
+    ts = df['ts'].values.astype('datetime64[ms]').astype(np.int64)
+    bucket = ts - ts % bin_ms
+    starts = np.flatnonzero(np.concatenate(([True], bucket[1:] != bucket[:-1])))
+    ends = np.append(starts[1:], len(ts))
+    if complete_before_ms is not None and bucket[starts[-1]] + bin_ms > complete_before_ms:
+        starts, ends = starts[:-1], ends[:-1]
+        if not len(starts):
+            return pd.DataFrame()
+        df = df.iloc[:ends[-1]]
+
+    f = lambda c: df[c].to_numpy(dtype=np.float64, na_value=np.nan)
+    vol = np.nan_to_num(f('volume'))
+    vwap = f('vwap')
+    pv = np.where(np.isnan(vwap), 0.0, vwap * vol)
+    vol_sum = np.add.reduceat(vol, starts)
+    pv_sum = np.add.reduceat(pv, starts)
+    trades = df['trades'].astype("Int64").fillna(0).to_numpy(dtype=np.int64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        vwap_out = np.where(vol_sum > 0, pv_sum / vol_sum, np.nan)
+    out = pd.DataFrame({
+        "symbol": df['symbol'].iat[0],
+        "ts": pd.to_datetime(bucket[starts], unit="ms", utc=True),
+        "open": f('open')[starts],
+        "high": np.maximum.reduceat(f('high'), starts),
+        "low": np.minimum.reduceat(f('low'), starts),
+        "close": f('close')[ends - 1],
+        "volume": vol_sum,
+        "vwap": vwap_out,
+        "trades": pd.array(np.add.reduceat(trades, starts), dtype="Int64"),
+    })
+    return out[COLUMNS]
+
+def resample_to(df, from_res, to_res, complete_before_ms=None):
+    # Walks the pyramid from from_res up to to_res.
+    chain = []
+    res = to_res
+    while res != from_res:
+        chain.append(res)
+        res = PARENT[res]
+    for i, res in enumerate(reversed(chain)):
+        last = i == len(chain) - 1
+        df = resample(df, RES_MS[res], complete_before_ms if last else None)
+    return df
+
+def fetch_range(symbol, res, start, end, api_key):
+    # fetch_aggs_range for any resolution: derived levels are built from one
+    # second-resolution fetch, dropping a last bar that is still filling.
+    if not derived(res):
+        return fetch_aggs_range(symbol, 1, res, start, end, api_key)
+    sec = fetch_aggs_range(symbol, 1, "second", start, end, api_key)
+    return resample_to(sec, "second", res, complete_before_ms=int(time.time() * 1000))
@@ -0,0 +1,272 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+import pytz
+from sqlalchemy import text
+
+import bar_store
+from hl_fsm import PARAM_KEYS, bars_from_df, initial_state, run_kernel, run_stream, shared_index, summarize_events
+from candle_store import backfill_stats, coverage_stats, day_stats, iter_candle_days
+from ingest import writer
+from market_calendar import trading_days
+
+US_EASTERN = pytz.timezone("America/New_York")
+
+# Backtest results per (symbol, resolution, day, params hash, seed low).
+#
+# A day can be evaluated on its own when the gap from the previous day's last
+# bar exceeds pattern_time_limit_ms: the FSM then resets on the day's first
+# bar, and only the previous bar's low (the swing check) carries over. That
+# low is the seed; with it the per-day events are exactly those of one run
+# over the whole range. When a gap is too short the range is run uncached.
+
+LRU_SIZE = 1024
+
+def params_hash(params):
+    # Same hash for the same values whatever their order or int/float typing.
+    canon = json.dumps([float(params[k]) for k in PARAM_KEYS])
+    return hashlib.sha1(canon.encode()).hexdigest()[:16]
+
+class LRU:
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.data:
+                return None
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+day_cache = LRU(LRU_SIZE)
+
+def _today_et():
+    return datetime.now(US_EASTERN).date()
+
+OCC_COLUMNS = ["a0_time", "a0_low", "a1_time", "a1_low", "a2_time", "a2_low",
+               "entry_time", "entry_price", "exit_time", "exit_price", "outcome", "profit"]
+_TIME_COLUMNS = {"a0_time", "a1_time", "a2_time", "entry_time", "exit_time"}
+
+def lookup_days(engine, symbol, res, h, keys):
+    # Stored events for the (day, seed_low) keys that have been computed.
+    if not keys:
+        return {}
+    days = sorted({d for d, _ in keys})
+    with engine.connect() as conn:
+        runs = conn.execute(text(
+            "select id, day, seed_low, patterns from public.backtest_days "
+            "where symbol = :symbol and resolution = :res and params_hash = :h and day = any(:days)"
+        ), {"symbol": symbol.upper(), "res": res, "h": h, "days": days}).fetchall()
+        wanted = set(keys)
+        runs = [r for r in runs if (r[1], r[2]) in wanted]
+        ids = [r[0] for r in runs if r[3]]
+        occ = conn.execute(text(
+            "select backtest_day_id, a0_time, a0_low::float8, a1_time, a1_low::float8, a2_time, a2_low::float8, "
+            "entry_time, entry_price::float8, exit_time, exit_price::float8, outcome, profit::float8 "
+            "from public.hl_occurrences where backtest_day_id = any(:ids) order by backtest_day_id, id"
+        ), {"ids": ids}).fetchall() if ids else []
+    by_id = {r[0]: [] for r in runs}
+    for row in occ:
+        by_id[row[0]].append({k: (pd.Timestamp(v).tz_convert("UTC") if k in _TIME_COLUMNS and v is not None else v)
+                              for k, v in zip(OCC_COLUMNS, row[1:])})
+    return {(r[1], r[2]): by_id[r[0]] for r in runs}
+
+def store_days(engine, symbol, res, h, params, results):
+    # results: [(day, seed_low, events)]. Runs on the write-behind thread; a
+    # day already stored by a concurrent run is left alone.
+    params_json = json.dumps({k: params[k] for k in PARAM_KEYS})
+    with engine.begin() as conn:
+        for day, seed, events in results:
+            row = conn.execute(text(
+                "insert into public.backtest_days "
+                "(symbol, resolution, day, params_hash, seed_low, patterns, wins, profit_sum) "
+                "values (:symbol, :res, :day, :h, :seed, :patterns, :wins, :profit_sum) "
+                "on conflict do nothing returning id"
+            ), {"symbol": symbol.upper(), "res": res, "day": day, "h": h, "seed": seed,
+                "patterns": len(events), "wins": sum(1 for e in events if e['outcome'] == 'take_profit'),
+                "profit_sum": float(sum(e['profit'] for e in events))}).fetchone()
+            if row is None or not events:
+                continue
+            conn.execute(text(
+                "insert into public.hl_occurrences (symbol, resolution, params_hash, backtest_day_id, params, "
+                + ", ".join(OCC_COLUMNS) + ") values (:symbol, :res, :h, :day_id, cast(:params as jsonb), "
+                + ", ".join(":" + c for c in OCC_COLUMNS) + ")"
+            ), [{"symbol": symbol.upper(), "res": res, "h": h, "day_id": row[0], "params": params_json,
+                 **{c: e[c] for c in OCC_COLUMNS}} for e in events])
+
+def save_run(engine, symbol, res, start, end, params, h, summary):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "insert into public.backtest_runs (symbol, resolution, start_date, end_date, params_hash, parameters, summary) "
+            "values (:symbol, :res, :start, :end, :h, cast(:params as jsonb), cast(:summary as jsonb))"
+        ), {"symbol": symbol.upper(), "res": res, "start": start, "end": end, "h": h,
+            "params": json.dumps({k: params[k] for k in PARAM_KEYS}), "summary": json.dumps(summary)})
+
+def period_group(start, end):
+    # W/M/Y depending on the span of the range.
+    span_days = (end - start).days + 1
+    if span_days <= 31:
+        return "W"
+    return "M" if span_days <= 370 else "Y"
+
+# Period labels as pandas' Period.__str__ prints them.
+_PERIOD_SQL = {
+    "W": "to_char(date_trunc('week', day::timestamp), 'YYYY-MM-DD') || '/' || "
+         "to_char(date_trunc('week', day::timestamp) + interval '6 days', 'YYYY-MM-DD')",
+    "M": "to_char(day, 'YYYY-MM')",
+    "Y": "to_char(day, 'YYYY')",
+}
+
+def period_rollup(engine, symbols, res, h, start, end, grp=None):
+    # The W/M/Y table summed in Postgres from the per-day aggregates in
+    # backtest_days. A day stored under several seeds counts once: the
+    # unseeded run on a symbol's first day in range, the chained run after.
+    grp = grp or period_group(start, end)
+    sql = text(
+        "with ranked as ("
+        " select symbol, day, seed_low, patterns, wins, profit_sum, computed_at,"
+        "  day = min(day) over (partition by symbol) as first_day"
+        " from public.backtest_days"
+        " where symbol = any(:symbols) and resolution = :res and params_hash = :h and day between :start and :end"
+        "), days as ("
+        " select distinct on (symbol, day) day, patterns, wins, profit_sum from ranked"
+        " order by symbol, day, ((seed_low is null) = first_day) desc, computed_at desc"
+        f") select {_PERIOD_SQL[grp]} as period, sum(patterns)::bigint as patterns, sum(wins)::bigint as wins,"
+        " sum(profit_sum) / sum(patterns) as avg_profit"
+        " from days group by 1 having sum(patterns) > 0 order by 1"
+    )
+    with engine.connect() as conn:
+        rows = conn.execute(sql, {"symbols": [s.upper() for s in symbols], "res": res, "h": h,
+                                  "start": start, "end": end}).fetchall()
+    rows = [{"period": r[0], "patterns": int(r[1]), "wins": int(r[2]), "avg_profit": float(r[3])} for r in rows]
+    cols = [{"name":c, "id":c} for c in ("period", "patterns", "wins", "avg_profit")] if rows else []
+    return rows, cols
+
+def _run_whole_range(engine, symbol, res, days, params, api_key, today):
+    # One FSM run over the range, for when a gap between days is too short to
+    # evaluate them separately; days are streamed with the state carried over.
+    rng = bar_store.get_range(symbol, res, days) if bar_store.enabled() and days[-1] < today else None
+    if rng is not None:
+        state = initial_state()
+        events = []
+        for _, *arrays in rng.segments():
+            ev, _, state = run_kernel(*arrays, params, state, collect_marks=False, index=shared_index(*arrays))
+            events.extend(ev)
+        return events, {"days": sum(1 for c in rng.cols if len(c["ts"])), "cached_days": 0}
+    n_days = 0
+    def frames():
+        nonlocal n_days
+        for _, df in iter_candle_days(engine, symbol, res, days, api_key):
+            n_days += not df.empty
+            yield df
+    events, _ = run_stream(frames(), params)
+    return events, {"days": n_days, "cached_days": 0}
+
+def run_backtest_cached(engine, symbol, res, start, end, params, api_key, progress=None):
+    # Events for the range plus {"days", "cached_days", "per_day"}; only days
+    # missing from the LRU and the database are loaded and run, streamed a
+    # few at a time so memory stays at about a day of bars. Today is never
+    # cached since its bars are still arriving. per_day is set when the range
+    # ran day by day, so every completed day ends up in backtest_days.
+    # progress(done, total) is called as days are resolved.
+    progress = progress or (lambda done, total: None)
+    days = trading_days(start, end)
+    if not days:
+        return [], {"days": 0, "cached_days": 0}
+    h = params_hash(params)
+    sym = symbol.upper()
+    today = _today_et()
+    limit = params['pattern_time_limit_ms']
+
+    # Per-day bar stats from coverage. Seeds are known up to the first day
+    # without stats; days from there on get theirs while streaming.
+    stats = coverage_stats(engine, symbol, res, start, end) if engine is not None else {}
+    keys = {}
+    prev = None
+    for d in days:
+        st = stats.get(d)
+        if st is None:
+            break
+        if not st['n_rows']:
+            continue
+        if prev is not None and st['first_ts'] - prev['last_ts'] <= limit:
+            return _run_whole_range(engine, symbol, res, days, params, api_key, today)
+        keys[d] = prev['last_low'] if prev else None
+        prev = st
+
+    found = {}
+    for d, seed in keys.items():
+        if d < today:
+            hit = day_cache.get((sym, res, h, d, seed))
+            if hit is not None:
+                found[(d, seed)] = hit
+    if engine is not None:
+        stored = lookup_days(engine, symbol, res, h, [(d, s) for d, s in keys.items()
+                                                      if (d, s) not in found and d < today])
+        for key, events in stored.items():
+            day_cache.put((sym, res, h) + key, events)
+        found.update(stored)
+    cached = len(found)
+    progress(cached, len(days))
+
+    need = [d for d in days if d not in stats or (stats[d]['n_rows'] and (d, keys.get(d, ())) not in found)]
+    frames = iter_candle_days(engine, symbol, res, need, api_key)
+    need = set(need)
+    plan, computed, new_stats = [], [], {}
+    prev = None
+    for i, d in enumerate(days, 1):
+        df = None
+        if d in need:
+            _, df = next(frames)
+            if d not in stats:
+                stats[d] = new_stats[d] = day_stats(df)
+        st = stats[d]
+        if not st['n_rows']:
+            continue
+        if prev is not None and st['first_ts'] - prev['last_ts'] <= limit:
+            frames.close()
+            return _run_whole_range(engine, symbol, res, days, params, api_key, today)
+        key = (d, prev['last_low'] if prev else None)
+        plan.append(key)
+        prev = st
+        if key in found:
+            continue
+        hit = day_cache.get((sym, res, h) + key) if d < today else None
+        if hit is not None:
+            found[key] = hit
+            cached += 1
+            continue
+        state = initial_state()
+        state['prev_low'] = key[1]
+        arrays = bars_from_df(df)
+        events, _, _ = run_kernel(*arrays, params, state, collect_marks=False, index=shared_index(*arrays))
+        found[key] = events
+        if d < today:
+            day_cache.put((sym, res, h) + key, events)
+            computed.append(key + (events,))
+        progress(max(i, cached), len(days))
+
+    events = [e for key in plan for e in found[key]]
+    info = {"days": len(plan), "cached_days": cached, "per_day": True}
+    if engine is not None:
+        if new_stats:
+            writer.submit(backfill_stats, engine, symbol, res,
+                          {d: st for d, st in new_stats.items() if d < today and st['n_rows']})
+        if computed:
+            writer.submit(store_days, engine, symbol, res, h, params, computed)
+        writer.submit(save_run, engine, symbol, res, start, end, params, h,
+                      dict(summarize_events(events), **info))
+    return events, info
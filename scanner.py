@@ -0,0 +1,308 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+import numpy as np
+import pytz
+
+import metrics
+from hl_fsm import DEFAULT_PARAMS, HLDetector, bars_from_df
+
+log = logging.getLogger(__name__)
+
+# Long-running HL scanner: many symbols on one asyncio event loop, one
+# HLDetector (the FSM state) per symbol. A source puts bar batches on a
+# bounded queue and the scanner turns BUY marks and closed trades into
+# signals on a feed. The feed is published as a small JSON file, the same
+# way metrics snapshots are, so dashboard workers in other processes can read
+# it; like jobs.py, the live scanner therefore runs in the web container next
+# to gunicorn (see Procfile), sharing its temp directory and METRICS_DIR.
+# Sources: Polygon polling for live use, and stored history replayed at an
+# adjustable speed for offline load tests.
+#
+#   python scanner.py live --symbols AAPL,MSFT,...
+#   python scanner.py replay --symbols AAPL,MSFT --start 2024-05-01 --end 2024-05-03 --speed 60
+
+US_EASTERN = pytz.timezone("America/New_York")
+
+SCANNER_SYMBOLS = os.environ.get("SCANNER_SYMBOLS", "")
+SCANNER_RES = os.environ.get("SCANNER_RES", "minute")
+POLL_SECONDS = float(os.environ.get("SCANNER_POLL_SECONDS", "5"))
+# Polygon requests in flight at once while polling.
+FETCH_CONCURRENCY = int(os.environ.get("SCANNER_FETCH_CONCURRENCY", "8"))
+FEED_PATH = os.environ.get("SCANNER_FEED_PATH", os.path.join(tempfile.gettempdir(), "hl_signals.json"))
+FEED_SIZE = 500
+FEED_FLUSH_SECONDS = 1
+# Bar batches waiting for the detector; a full queue holds the source back.
+QUEUE_SIZE = 10_000
+# Threads loading replay days; the next day is loaded while one plays.
+REPLAY_LOADERS = 4
+
+class SignalFeed:
+    # Ring of the latest signals, each numbered with an increasing seq so a
+    # reader can ask for what it has not seen yet.
+    def __init__(self, size=FEED_SIZE, path=None):
+        self.signals = deque(maxlen=size)
+        self.seq = 0
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirty = False
+
+    def push(self, signal):
+        with self.lock:
+            self.seq += 1
+            signal = dict(signal, seq=self.seq)
+            self.signals.append(signal)
+            self.dirty = True
+        return signal
+
+    def since(self, seq=0):
+        with self.lock:
+            return [s for s in self.signals if s["seq"] > seq]
+
+    def flush(self):
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            data = list(self.signals)
+            self.dirty = False
+        d = os.path.dirname(self.path) or "."
+        fd, tmp = tempfile.mkstemp(dir=d, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"updated": time.time(), "signals": data}, f)
+        os.replace(tmp, self.path)
+
+_read_cache = {"mtime": None, "signals": []}
+
+def read_feed(since=0, path=None):
+    # Signals published by a scanner process, newest last; re-read only
+    # when the file changed.
+    path = path or FEED_PATH
+    try:
+        mtime = os.path.getmtime(path)
+        if mtime != _read_cache["mtime"]:
+            with open(path) as f:
+                signals = json.load(f)["signals"]
+            _read_cache.update(mtime=mtime, signals=signals)
+    except (OSError, ValueError, KeyError):
+        return []
+    return [s for s in _read_cache["signals"] if s["seq"] > since]
+
+class Scanner:
+    # Per-symbol detectors fed bar batches in time order.
+    def __init__(self, params, feed, keep_latencies=False):
+        self.params = dict(params)
+        self.feed = feed
+        self.detectors = {}
+        self.bars = 0
+        # every signal's latency, for replay reports; live runs only feed
+        # the SIGNAL_LATENCY histogram
+        self.latencies = [] if keep_latencies else None
+
+    def on_bars(self, symbol, ts, low, high, close, received=None):
+        # received: perf_counter time the bars reached the scanner, or None
+        # for warm-up history whose signals are stale and not published.
+        det = self.detectors.get(symbol)
+        if det is None:
+            det = self.detectors[symbol] = HLDetector(self.params)
+        events, marks = det.feed((ts, low, high, close))
+        self.bars += len(ts)
+        if received is None:
+            return
+        for m in marks:
+            if m["label"] == "BUY":
+                self._push(received, symbol=symbol, kind="BUY", ts=m["ts"].isoformat(), price=m["price"])
+        for e in events:
+            self._push(received, symbol=symbol, kind=e["outcome"], ts=e["exit_time"].isoformat(),
+                       price=e["exit_price"], entry_price=e["entry_price"], profit=e["profit"])
+
+    def _push(self, received, **signal):
+        self.feed.push(dict(signal, at=time.time()))
+        lat = time.perf_counter() - received
+        if self.latencies is not None:
+            self.latencies.append(lat)
+        metrics.SIGNAL_LATENCY.observe(lat)
+        metrics.SCANNER_SIGNALS.inc(kind=signal["kind"])
+
+async def _consume(scanner, queue):
+    # Runs until the source puts None.
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        scanner.on_bars(*item)
+
+async def _flush_feed(feed):
+    while True:
+        await asyncio.sleep(FEED_FLUSH_SECONDS)
+        try:
+            feed.flush()
+        except OSError:
+            log.exception("signal feed flush failed")
+
+def _session_start_ms(day):
+    midnight = US_EASTERN.localize(datetime.combine(day, datetime.min.time()))
+    return int(midnight.timestamp() * 1000)
+
+async def poll_source(symbols, res, api_key, queue, poll_seconds=POLL_SECONDS, concurrency=FETCH_CONCURRENCY):
+    # Polls Polygon for bars newer than each symbol's last one. The first
+    # poll of a day warms the detectors up on the day so far.
+    from resample import RES_MS, fetch_range
+
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="scanner-fetch")
+    sem = asyncio.Semaphore(concurrency)
+    base_ms = RES_MS[res]
+    last = {}
+
+    async def poll(symbol, day, warm):
+        async with sem:
+            start = last[symbol] + base_ms if symbol in last else _session_start_ms(day)
+            df = await loop.run_in_executor(pool, fetch_range, symbol, res, start,
+                                            int(time.time() * 1000), api_key)
+        if df is None or df.empty:
+            return
+        ts, low, high, close = bars_from_df(df)
+        last[symbol] = int(ts[-1])
+        await queue.put((symbol, ts, low, high, close, None if warm else time.perf_counter()))
+
+    day = None
+    try:
+        while True:
+            t0 = loop.time()
+            today = datetime.now(US_EASTERN).date()
+            warm = today != day
+            if warm:
+                day = today
+                last.clear()
+            results = await asyncio.gather(*(poll(s, day, warm) for s in symbols), return_exceptions=True)
+            for s, r in zip(symbols, results):
+                if isinstance(r, Exception):
+                    log.warning("scanner poll %s failed: %s", s, r)
+            await asyncio.sleep(max(0.0, poll_seconds - (loop.time() - t0)))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _load_replay_day(engine, symbols, res, day, api_key):
+    # All symbols' bars of one day merged in time order as (symbol index,
+    # ts, low, high, close) arrays.
+    from candle_store import load_candles
+
+    with ThreadPoolExecutor(max_workers=REPLAY_LOADERS) as pool:
+        frames = list(pool.map(lambda s: load_candles(engine, s, res, day, day, api_key), symbols))
+    parts = [(np.full(len(df), i), *bars_from_df(df)) for i, df in enumerate(frames) if not df.empty]
+    if not parts:
+        return None
+    sym, ts, low, high, close = (np.concatenate(c) for c in zip(*parts))
+    order = np.argsort(ts, kind="stable")
+    return sym[order], ts[order], low[order], high[order], close[order]
+
+async def replay_source(engine, symbols, res, start, end, api_key, queue, speed=1.0):
+    # Stored history of the symbols put on the queue bar timestamp by bar
+    # timestamp, at speed times real time (0 = as fast as the scanner takes
+    # them). Time does not pass between days.
+    from market_calendar import trading_days
+
+    loop = asyncio.get_running_loop()
+    days = trading_days(start, end)
+    nxt = loop.run_in_executor(None, _load_replay_day, engine, symbols, res, days[0], api_key) if days else None
+    for k in range(len(days)):
+        merged = await nxt
+        nxt = (loop.run_in_executor(None, _load_replay_day, engine, symbols, res, days[k + 1], api_key)
+               if k + 1 < len(days) else None)
+        if merged is None:
+            continue
+        sym, ts, low, high, close = merged
+        starts = np.flatnonzero(np.concatenate(([True], ts[1:] != ts[:-1])))
+        ends = np.append(starts[1:], len(ts))
+        wall0, ts0 = loop.time(), int(ts[0])
+        for a, b in zip(starts.tolist(), ends.tolist()):
+            if speed > 0:
+                delay = wall0 + (int(ts[a]) - ts0) / 1000 / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            now = time.perf_counter()
+            for j in range(a, b):
+                await queue.put((symbols[sym[j]], ts[j:j+1], low[j:j+1], high[j:j+1], close[j:j+1], now))
+    await queue.put(None)
+
+async def run_scanner(source, scanner, queue):
+    # Runs the source and the detector loop together until the source ends.
+    flusher = asyncio.create_task(_flush_feed(scanner.feed))
+    consumer = asyncio.create_task(_consume(scanner, queue))
+    producer = asyncio.create_task(source)
+    try:
+        await asyncio.wait({consumer, producer}, return_when=asyncio.FIRST_EXCEPTION)
+        for t in (producer, consumer):
+            if t.done() and t.exception():
+                raise t.exception()
+        await consumer
+    finally:
+        for t in (flusher, consumer, producer):
+            t.cancel()
+        scanner.feed.flush()
+
+def replay(engine, symbols, res, start, end, api_key, params=None, speed=0.0, feed=None):
+    # Replays the range through a scanner; returns throughput and latency
+    # figures for load tests.
+    scanner = Scanner(params or DEFAULT_PARAMS, feed or SignalFeed(), keep_latencies=True)
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    t0 = time.perf_counter()
+    asyncio.run(run_scanner(replay_source(engine, symbols, res, start, end, api_key, queue, speed),
+                            scanner, queue))
+    wall = time.perf_counter() - t0
+    lat = np.array(scanner.latencies) * 1000
+    return {
+        "symbols": len(symbols), "bars": scanner.bars, "seconds": wall,
+        "bars_per_second": scanner.bars / wall if wall else 0.0,
+        "signals": len(lat),
+        "latency_ms_p50": float(np.percentile(lat, 50)) if len(lat) else None,
+        "latency_ms_p99": float(np.percentile(lat, 99)) if len(lat) else None,
+        "latency_ms_max": float(lat.max()) if len(lat) else None,
+    }
+
+def live(symbols, res, api_key, params=None, feed=None):
+    metrics.export()
+    scanner = Scanner(params or DEFAULT_PARAMS, feed or SignalFeed(path=FEED_PATH))
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    asyncio.run(run_scanner(poll_source(symbols, res, api_key, queue), scanner, queue))
+
+def main(argv=None):
+    from universe import parse_symbols
+
+    ap = argparse.ArgumentParser(description="Multi-symbol HL scanner.")
+    ap.add_argument("mode", choices=["live", "replay"])
+    ap.add_argument("--symbols", default=SCANNER_SYMBOLS, help="comma separated; default SCANNER_SYMBOLS")
+    ap.add_argument("--res", default=SCANNER_RES)
+    ap.add_argument("--start", type=date.fromisoformat)
+    ap.add_argument("--end", type=date.fromisoformat)
+    ap.add_argument("--speed", type=float, default=0.0,
+                    help="replay speed as a multiple of real time; 0 replays as fast as possible")
+    ap.add_argument("--feed", default=None, help="also publish replayed signals to this file")
+    args = ap.parse_args(argv)
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+    symbols = parse_symbols(args.symbols)
+    if not symbols:
+        ap.error("no symbols: pass --symbols or set SCANNER_SYMBOLS")
+    api_key = os.environ.get("POLYGON_API_KEY")
+    if args.mode == "live":
+        live(symbols, args.res, api_key)
+        return 0
+    if not args.start:
+        ap.error("replay needs --start")
+    from db import make_engine
+    out = replay(make_engine(), symbols, args.res, args.start, args.end or args.start, api_key,
+                 speed=args.speed, feed=SignalFeed(path=args.feed))
+    print(json.dumps(out, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
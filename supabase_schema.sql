@@ -14,7 +14,12 @@ create table if not exists public.candles_minute (
   trades bigint,
   day date generated always as (date(ts at time zone 'America/New_York')) stored
 );
-create index if not exists idx_candles_minute_symbol_ts on public.candles_minute(symbol, ts);
+-- (symbol, ts) is unique so re-ingesting a day is a no-op; older databases
+-- had a plain index and duplicate rows, which are removed first
+delete from public.candles_minute a using public.candles_minute b
+  where a.symbol = b.symbol and a.ts = b.ts and a.id > b.id;
+create unique index if not exists uq_candles_minute_symbol_ts on public.candles_minute(symbol, ts);
+drop index if exists public.idx_candles_minute_symbol_ts;
 
 create table if not exists public.candles_second (
   id bigserial primary key,
@@ -29,7 +34,12 @@ create table if not exists public.candles_second (
   trades bigint,
   day date generated always as (date(ts at time zone 'America/New_York')) stored
 );
-create index if not exists idx_candles_second_symbol_ts on public.candles_second(symbol, ts);
+-- (symbol, ts) is unique so re-ingesting a day is a no-op; older databases
+-- had a plain index and duplicate rows, which are removed first
+delete from public.candles_second a using public.candles_second b
+  where a.symbol = b.symbol and a.ts = b.ts and a.id > b.id;
+create unique index if not exists uq_candles_second_symbol_ts on public.candles_second(symbol, ts);
+drop index if exists public.idx_candles_second_symbol_ts;
 
 create table if not exists public.hl_occurrences (
   id bigserial primary key,
@@ -71,3 +81,59 @@ create table if not exists public.fine_tune_results (
   params jsonb,
   metrics jsonb
 );
+
+-- (symbol, resolution, day) slices whose candles are fully stored; days
+-- listed here are served from the candle tables instead of Polygon
+create table if not exists public.candle_coverage (
+  symbol text not null,
+  resolution text not null check (resolution in ('minute','second')),
+  day date not null,
+  n_rows integer not null default 0,
+  first_ts bigint,
+  last_ts bigint,
+  last_low float8,
+  stored_at timestamptz default now(),
+  primary key (symbol, resolution, day)
+);
+-- first/last bar time (epoch ms) and last low of the day, used to chain
+-- cached per-day backtests without reading the candles
+alter table public.candle_coverage add column if not exists first_ts bigint;
+alter table public.candle_coverage add column if not exists last_ts bigint;
+alter table public.candle_coverage add column if not exists last_low float8;
+-- Resolutions built from second bars (resample.py) only get stats rows,
+-- under '<res>_derived', since their candles are not stored
+alter table public.candle_coverage drop constraint if exists candle_coverage_resolution_check;
+alter table public.candle_coverage add constraint candle_coverage_resolution_check
+  check (resolution in ('minute','second','minute_derived','5minute_derived','15minute_derived','hour_derived'));
+
+-- One FSM evaluation of a (symbol, resolution, day) under one parameter set,
+-- identified by its canonical hash. seed_low is the low of the bar before the
+-- day (null at the start of a range): once the pattern time limit has run
+-- out over the overnight gap it is the only state that crosses into the day.
+create table if not exists public.backtest_days (
+  id bigserial primary key,
+  symbol text not null,
+  resolution text not null check (resolution in ('minute','second')),
+  day date not null,
+  params_hash text not null,
+  seed_low float8,
+  patterns integer not null default 0,
+  wins integer not null default 0,
+  profit_sum float8 not null default 0,
+  computed_at timestamptz default now(),
+  unique nulls not distinct (symbol, resolution, params_hash, day, seed_low)
+);
+
+alter table public.hl_occurrences add column if not exists resolution text;
+alter table public.hl_occurrences add column if not exists params_hash text;
+alter table public.hl_occurrences add column if not exists backtest_day_id bigint
+  references public.backtest_days(id) on delete cascade;
+create index if not exists idx_hl_occ_backtest_day on public.hl_occurrences(backtest_day_id);
+
+alter table public.backtest_runs add column if not exists resolution text;
+alter table public.backtest_runs add column if not exists params_hash text;
+
+-- backtest_days doubles as the per-day aggregate that period tables are
+-- summed from in SQL (result_cache.period_rollup); this serves rollups over
+-- many symbols for one parameter set
+create index if not exists idx_backtest_days_hash_day on public.backtest_days(params_hash, resolution, day);
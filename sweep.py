@@ -0,0 +1,337 @@
+import itertools
+import json
+import math
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from sqlalchemy import text
+
+from hl_fsm import (DEFAULT_PARAMS, PARAM_KEYS, bars_from_df, batch_metrics, initial_state, params_matrix,
+                    run_kernel, shared_index, summarize_events)
+
+# Millisecond parameters are kept integral in generated grids.
+INT_KEYS = {"pattern_time_limit_ms", "time_to_wait_before_confirm_Ax_ms", "trade_timeout_ms"}
+
+# Default search box for the random / Latin hypercube generators.
+DEFAULT_BOUNDS = {
+  "max_price_increase_above_A0": (0.10, 1.00),
+  "price_increase_to_confirm_A0": (0.01, 0.20),
+  "max_decrease_below_A0": (0.05, 0.50),
+  "price_increase_to_confirm_higher_low": (0.01, 0.20),
+  "pattern_time_limit_ms": (5*60*1000, 60*60*1000),
+  "take_profit_offset": (0.10, 1.00),
+  "stop_loss_offset": (0.02, 0.20),
+  "time_to_wait_before_confirm_Ax_ms": (0, 10*60*1000),
+  "price_increase_from_A2_to_enter_trade": (0.00, 0.10),
+  "trade_timeout_ms": (5*60*1000, 90*60*1000)
+}
+
+def _row(values):
+    p = dict(DEFAULT_PARAMS)
+    for k, v in values.items():
+        p[k] = int(round(v)) if k in INT_KEYS else round(float(v), 6)
+    return p
+
+def cartesian_grid(ranges):
+    # ranges: key -> list of values, or (start, stop, step) inclusive of stop.
+    # Keys not given stay at DEFAULT_PARAMS.
+    axes = {}
+    for k, r in ranges.items():
+        if isinstance(r, tuple) and len(r) == 3:
+            start, stop, step = r
+            r = np.arange(start, stop + step/2, step).tolist()
+        axes[k] = list(r)
+    keys = list(axes)
+    return [_row(dict(zip(keys, combo))) for combo in itertools.product(*(axes[k] for k in keys))]
+
+def random_grid(n, bounds=None, seed=None):
+    bounds = bounds or DEFAULT_BOUNDS
+    rng = np.random.default_rng(seed)
+    keys = list(bounds)
+    lo = np.array([bounds[k][0] for k in keys], dtype=float)
+    hi = np.array([bounds[k][1] for k in keys], dtype=float)
+    u = rng.random((n, len(keys)))
+    return [_row(dict(zip(keys, row))) for row in (lo + u * (hi - lo)).tolist()]
+
+def latin_hypercube_grid(n, bounds=None, seed=None):
+    # One sample per stratum on every axis, strata shuffled independently.
+    bounds = bounds or DEFAULT_BOUNDS
+    rng = np.random.default_rng(seed)
+    keys = list(bounds)
+    lo = np.array([bounds[k][0] for k in keys], dtype=float)
+    hi = np.array([bounds[k][1] for k in keys], dtype=float)
+    u = (np.arange(n)[:, None] + rng.random((n, len(keys)))) / n
+    for j in range(len(keys)):
+        u[:, j] = u[rng.permutation(n), j]
+    return [_row(dict(zip(keys, row))) for row in (lo + u * (hi - lo)).tolist()]
+
+GRID_GENERATORS = {"random": random_grid, "lhs": latin_hypercube_grid}
+
+class SharedBars:
+    # ts/low/high/close packed into one shared memory block so pool workers
+    # attach to the same pages instead of receiving a pickled frame per task.
+    def __init__(self, ts, low, high, close):
+        n = len(ts)
+        self.n = n
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, 32 * n))
+        views = _views(self.shm.buf, n)
+        for dst, src in zip(views, (ts, low, high, close)):
+            dst[:] = src
+
+    @classmethod
+    def from_df(cls, df):
+        return cls(*bars_from_df(df))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def arrays(self):
+        return _views(self.shm.buf, self.n)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _views(buf, n):
+    ts = np.ndarray((n,), dtype=np.int64, buffer=buf, offset=0)
+    low = np.ndarray((n,), dtype=np.float64, buffer=buf, offset=8*n)
+    high = np.ndarray((n,), dtype=np.float64, buffer=buf, offset=16*n)
+    close = np.ndarray((n,), dtype=np.float64, buffer=buf, offset=24*n)
+    return ts, low, high, close
+
+def _attached_metrics(name, n, pm, seed_low):
+    # Pool task for run_sweep_days: the bars block changes every day, so it is
+    # attached per task rather than once in an initializer.
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return batch_metrics(*_views(shm.buf, n), pm, seed_low)
+    finally:
+        shm.close()
+
+def _add_totals(totals, metrics, rows=None):
+    # Accumulates (patterns, wins, profit) per set from batch metrics.
+    rows = range(len(metrics)) if rows is None else rows
+    for j, m in zip(rows, metrics):
+        totals[j] += (m["patterns"], m["win_rate_pct"] * m["patterns"] / 100, m["avg_profit"] * m["patterns"])
+
+def _totals_metrics(totals):
+    out = []
+    for patterns, wins, profit in totals.tolist():
+        patterns = int(round(patterns))
+        out.append({
+            "patterns": patterns,
+            "win_rate_pct": (wins/patterns*100) if patterns else 0.0,
+            "avg_profit": (profit/patterns) if patterns else 0.0
+        })
+    return out
+
+def _seeded(frames, seeds):
+    # (frame, seed low) pairs; without seeds each day is seeded with the last
+    # low of the non-empty day before it, as result_cache chains days.
+    if seeds is not None:
+        yield from zip(frames, seeds)
+        return
+    seed = None
+    for df in frames:
+        yield df, seed
+        if df is not None and not df.empty:
+            seed = float(df['low'].iat[-1])
+
+def _span_ms(df):
+    # Epoch ms of the day's first and last bar.
+    first, last = df['ts'].values[[0, -1]].astype('datetime64[ms]').astype('int64').tolist()
+    return first, last
+
+def _carry(carried, params_list, prev, df):
+    # Sets whose pattern_time_limit_ms spans the gap between prev's day and
+    # df's cannot start df afresh, so from here on they run with the FSM
+    # state carried across days. Every earlier gap reset them, so the state
+    # they enter df with is that of prev's day run on its own.
+    prev_df, prev_seed = prev
+    gap = _span_ms(df)[0] - _span_ms(prev_df)[1]
+    arrays = None
+    for j, p in enumerate(params_list):
+        if j not in carried and p['pattern_time_limit_ms'] >= gap:
+            arrays = arrays or bars_from_df(prev_df)
+            state = dict(initial_state(), prev_low=prev_seed)
+            carried[j] = run_kernel(*arrays, p, state, collect_marks=False, index=shared_index(*arrays))[2]
+
+def _done(value):
+    f = Future()
+    f.set_result(value)
+    return f
+
+def run_sweep_days(frames, params_list, workers=None, chunks_per_worker=4, progress=None, seeds=None):
+    # Metrics for every parameter set, in order, over a range given as day
+    # frames in order (e.g. from candle_store.iter_candle_days), so only a
+    # day or two of bars is held at once. Each day is scored by every set in
+    # one batch pass, fanned out over a process pool, and the counts summed;
+    # the next day is loaded while the pool works on the current one.
+    # A day scored on its own starts from phase 1 with the previous day's
+    # last low as the swing seed, which is exactly one run over the range
+    # whenever the overnight gap exceeds pattern_time_limit_ms (the per-day
+    # backtest cache relies on the same). Sets whose limit spans a gap run
+    # one at a time from that day on, with the state carried over.
+    # seeds: the seed low per frame, for days that are not consecutive; the
+    # caller then vouches that every gap resets every set.
+    # progress(n_days_done) is called after each day; an exception raised
+    # from it cancels the work not yet started.
+    if not params_list:
+        return []
+    pm = params_matrix(params_list)
+    workers = workers or os.cpu_count() or 1
+    inline = workers == 1 or len(pm) <= 32
+    totals = np.zeros((len(pm), 3))
+    carried = {}  # set index -> FSM state after the last day
+    prev = None   # (frame, seed) of the last non-empty day
+    pending = None  # (shared bars, set rows, futures) of the day being scored
+    n_days = 0
+    pool = None if inline else ProcessPoolExecutor(max_workers=workers)
+    try:
+        for item in itertools.chain(_seeded((f[1] if isinstance(f, tuple) else f for f in frames), seeds), [None]):
+            day = None
+            if item is not None:
+                df, seed = item
+                if df is not None and not df.empty:
+                    if prev is not None and seeds is None:
+                        _carry(carried, params_list, prev, df)
+                    rows = np.array([j for j in range(len(pm)) if j not in carried], dtype=int)
+                    if len(rows) and inline:
+                        day = (None, rows, [_done(batch_metrics(*bars_from_df(df), pm[rows], seed))])
+                    elif len(rows):
+                        bars = SharedBars.from_df(df)
+                        chunks = np.array_split(pm[rows], min(len(rows), workers * chunks_per_worker))
+                        day = (bars, rows, [pool.submit(_attached_metrics, bars.name, bars.n, c, seed) for c in chunks])
+                    if carried:
+                        arrays = bars_from_df(df)
+                        index = shared_index(*arrays)
+                        for j, state in carried.items():
+                            events, _, carried[j] = run_kernel(*arrays, params_list[j], state, collect_marks=False,
+                                                               index=index)
+                            _add_totals(totals, [summarize_events(events)], [j])
+                    prev = (df, seed)
+                del df
+            if pending is not None:
+                bars, rows, futures = pending
+                pending = None
+                try:
+                    _add_totals(totals, [m for f in futures for m in f.result()], rows)
+                finally:
+                    if bars is not None:
+                        bars.close()
+            pending = day
+            if item is not None:
+                n_days += 1
+            if progress and (item is None or n_days > 1):
+                progress(n_days if item is None else n_days - 1)
+    except BaseException:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if pending is not None and pending[0] is not None:
+            pending[0].close()
+        raise
+    if pool is not None:
+        pool.shutdown()
+    return _totals_metrics(totals)
+
+def _carried_day_totals(frames, params):
+    # (patterns, wins, profit) each frame contributes to one run of a set
+    # over all the frames with the state carried across them.
+    state = initial_state()
+    out = []
+    for df in frames:
+        arrays = bars_from_df(df)
+        events, _, state = run_kernel(*arrays, params, state, collect_marks=False, index=shared_index(*arrays))
+        out.append(np.array([len(events), sum(e['outcome'] == 'take_profit' for e in events),
+                             sum(e['profit'] for e in events)], dtype=float))
+    return out
+
+def halving_schedule(n_sets, n_days, eta=3, min_days=1):
+    # [(sets alive, days scored on)] per round of successive halving: the
+    # sets shrink by eta and the days grow by eta until the last round
+    # scores the survivors on every day.
+    if n_sets <= 0 or n_days <= 0:
+        return []
+    rounds = int(math.log(n_sets, eta) + 1e-9) if n_sets > 1 else 0
+    days = min(n_days, max(min_days, math.ceil(n_days / eta**rounds)))
+    sched = [(n_sets, days)]
+    while days < n_days:
+        n_sets = max(1, math.ceil(n_sets / eta))
+        days = min(n_days, days * eta)
+        sched.append((n_sets, days))
+    return sched
+
+def successive_halving(day_frames, params_list, eta=3, min_days=1, seed=0, workers=None, progress=None):
+    # Scores every set on a random sample of days, keeps the best 1/eta by
+    # total profit and rescores the survivors on eta times as many days,
+    # until the last ones have seen the whole range. Survivors carry their
+    # totals between rounds, so each round only runs the days it adds. Every
+    # day is scored on its own, seeded like run_sweep_days, so the totals
+    # over all days equal the exhaustive sweep's. Sets whose time limit spans
+    # an overnight gap cannot be scored a day at a time; they run once over
+    # the whole range up front and each round adds their per-day counts.
+    # Returns per-set metrics over the days each set was scored on (with
+    # "days" and "total_profit") and {"rounds", "runs", "exhaustive_runs"},
+    # runs counting (set, day) evaluations. progress(runs_done, runs_planned).
+    days = sorted(d for d, f in day_frames.items() if f is not None and not f.empty)
+    n = len(params_list)
+    if not n or not days:
+        return [], {"rounds": 0, "runs": 0, "exhaustive_runs": 0}
+    order = [days[i] for i in np.random.default_rng(seed).permutation(len(days))]
+    sched = halving_schedule(n, len(days), eta, min_days)
+    planned = sum(k * (d - (sched[i-1][1] if i else 0)) for i, (k, d) in enumerate(sched))
+    # the last low of the day before, as when the range is streamed in order
+    seed_of = dict(zip(days, [None] + [float(day_frames[d]['low'].iat[-1]) for d in days[:-1]]))
+    spans = [_span_ms(day_frames[d]) for d in days]
+    min_gap = min((b[0] - a[1] for a, b in zip(spans, spans[1:])), default=math.inf)
+    carried = {j: dict(zip(days, _carried_day_totals([day_frames[d] for d in days], p)))
+               for j, p in enumerate(params_list) if p['pattern_time_limit_ms'] >= min_gap}
+
+    totals = np.zeros((n, 3))  # patterns, wins, profit over the days scored
+    scored = np.zeros(n, dtype=int)
+    alive = np.arange(n)
+    runs = 0
+    for i, (k, n_days) in enumerate(sched):
+        if len(alive) > k:
+            # by total profit; ties keep the lower set index
+            best = np.lexsort((alive, -totals[alive, 2]))[:k]
+            alive = np.sort(alive[best])
+        new = order[scored[alive[0]]:n_days]
+        new = sorted(new)
+        done0, n_alive = runs, len(alive)
+        step = (lambda m: progress(done0 + m * n_alive, planned)) if progress else None
+        rows = np.array([j for j in alive if j not in carried], dtype=int)
+        _add_totals(totals, run_sweep_days([day_frames[d] for d in new], [params_list[j] for j in rows],
+                                           workers=workers, progress=step, seeds=[seed_of[d] for d in new]), rows)
+        for j in alive:
+            if j in carried:
+                totals[j] += sum(carried[j][d] for d in new)
+        scored[alive] = n_days
+        runs += len(alive) * len(new)
+
+    out = _totals_metrics(totals)
+    for m, profit, n_days in zip(out, totals[:, 2].tolist(), scored.tolist()):
+        m.update(total_profit=profit, days=n_days)
+    return out, {"rounds": len(sched), "runs": runs, "exhaustive_runs": n * len(days)}
+
+def save_sweep_results(engine, symbol, start, end, params_list, metrics):
+    if engine is None or not params_list:
+        return
+    rows = [{
+        "symbol": symbol.upper(), "start_date": start, "end_date": end,
+        "params": json.dumps({k: p[k] for k in PARAM_KEYS}), "metrics": json.dumps(m)
+    } for p, m in zip(params_list, metrics)]
+    with engine.begin() as conn:
+        conn.execute(text(
+            "insert into public.fine_tune_results (symbol, start_date, end_date, params, metrics) "
+            "values (:symbol, :start_date, :end_date, cast(:params as jsonb), cast(:metrics as jsonb))"
+        ), rows)
@@ -0,0 +1,90 @@
+from datetime import datetime, time
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from market_calendar import trading_days
+
+# Deterministic synthetic OHLC bars for benchmarks: a random walk over
+# regular trading hours with complete A0/A1/A2 higher-low sequences planted
+# at intervals, shaped so DEFAULT_PARAMS detects and trades them.
+
+US_EASTERN = pytz.timezone("America/New_York")
+
+BAR_MS = {"minute": 60_000, "second": 1_000}
+SESSION_MS = 390 * 60_000
+
+# (minutes from start, price relative to the walk at the start) waypoints of
+# one planted pattern: drop to A0, confirm, dip to the higher low A1, confirm,
+# dip to A2, confirm, pull back to the entry, then run to the take profit.
+PATTERN = [
+    (0, 0.00), (2, -0.30), (4, -0.12), (8, -0.10), (10, -0.20),
+    (12, -0.05), (17, -0.04), (19, -0.15), (22, -0.02), (24, -0.14),
+    (30, 0.45)
+]
+PATTERN_MINUTES = PATTERN[-1][0]
+
+def _pattern_path(bar_ms):
+    # Cumulative offsets of the planted pattern, one per bar.
+    t = np.arange(0, PATTERN_MINUTES * 60_000 + 1, bar_ms) / 60_000
+    xs, ys = zip(*PATTERN)
+    return np.interp(t, xs, ys)
+
+def synthetic_bars(start, end, res="minute", symbol="SYN", seed=0, patterns_per_day=6,
+                   price=100.0, vol=0.02):
+    # Bars for every trading day in [start, end]; vol is the walk's standard
+    # deviation per minute. Same arguments, same frame.
+    rng = np.random.default_rng(seed)
+    bar_ms = BAR_MS[res]
+    per_day = SESSION_MS // bar_ms
+    path = _pattern_path(bar_ms)
+    frames = []
+    for d in trading_days(start, end):
+        open_ms = int(US_EASTERN.localize(datetime.combine(d, time(9, 30))).timestamp() * 1000)
+        steps = rng.normal(0.0, vol * np.sqrt(bar_ms / 60_000), per_day)
+        # plant patterns at evenly spread, jittered starts
+        slot = per_day // max(1, patterns_per_day)
+        for k in range(patterns_per_day):
+            lo = k * slot
+            room = slot - len(path)
+            if room <= 0:
+                break
+            at = lo + int(rng.integers(0, room))
+            steps[at + 1:at + len(path)] = np.diff(path)
+        close = price + np.cumsum(steps)
+        price = float(close[-1])
+        spread = np.abs(rng.normal(0.0, vol / 4, per_day))
+        prev = np.concatenate(([close[0]], close[:-1]))
+        frames.append(pd.DataFrame({
+            "ts": pd.to_datetime(open_ms + np.arange(per_day, dtype=np.int64) * bar_ms, unit="ms", utc=True),
+            "open": prev,
+            "high": np.maximum(prev, close) + spread,
+            "low": np.minimum(prev, close) - spread,
+            "close": close,
+            "volume": rng.integers(100, 10_000, per_day).astype(np.float64),
+            "vwap": (prev + close) / 2,
+            "trades": rng.integers(1, 200, per_day)
+        }))
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    df.insert(0, "symbol", symbol.upper())
+    df["trades"] = df["trades"].astype("Int64")
+    return df
+
+def aggs_page(df, next_url=None):
+    # The bars as a Polygon aggregates response page.
+    ms = df["ts"].values.astype("datetime64[ms]").astype(np.int64)
+    results = [
+        {"v": v, "vw": round(vw, 4), "o": round(o, 4), "c": round(c, 4), "h": round(h, 4), "l": round(l, 4),
+         "t": t, "n": n}
+        for v, vw, o, c, h, l, t, n in zip(df["volume"].tolist(), df["vwap"].tolist(), df["open"].tolist(),
+                                           df["close"].tolist(), df["high"].tolist(), df["low"].tolist(),
+                                           ms.tolist(), df["trades"].astype("int64").tolist())
+    ]
+    page = {"ticker": df["symbol"].iat[0] if len(df) else "", "status": "OK", "adjusted": True,
+            "queryCount": len(results), "resultsCount": len(results), "results": results}
+    if next_url:
+        page["next_url"] = next_url
+    return page
@@ -0,0 +1,163 @@
+import os
+from datetime import date, datetime
+
+import pandas as pd
+import pytz
+
+import metrics
+from hl_fsm import DEFAULT_PARAMS, summarize_events
+from candle_store import iter_candle_days
+from db import make_engine
+from ingest import writer
+from market_calendar import trading_days
+from result_cache import params_hash, period_group, period_rollup, run_backtest_cached
+from sweep import GRID_GENERATORS, run_sweep_days, save_sweep_results, successive_halving
+from universe import leaderboard, run_universe
+
+# Job bodies run by jobs.py workers. Each takes the JSON args the UI
+# submitted and a progress(done, total, note) callback, and returns the
+# JSON-able payload the UI renders.
+
+POLYGON_API_KEY = os.environ.get("POLYGON_API_KEY")
+US_EASTERN = pytz.timezone("America/New_York")
+
+# Trading days loaded per round trip while preparing a halving search.
+SWEEP_LOAD_DAYS = 5
+
+_engine = None
+
+def today_et():
+    return datetime.now(US_EASTERN).date()
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = make_engine()
+    return _engine
+
+def period_rows(occ, start, end):
+    # In-memory counterpart of result_cache.period_rollup, for runs that are
+    # not stored day by day.
+    if not occ:
+        return [], []
+    df_occ = pd.DataFrame(occ)
+    day = df_occ['a0_time'].dt.tz_convert(US_EASTERN).dt.tz_localize(None)
+    df_occ['period'] = day.dt.to_period(period_group(start, end)).astype(str)
+    df_occ['win'] = df_occ['outcome'] == 'take_profit'
+    agg = df_occ.groupby('period').agg(
+        patterns=('a0_time','count'),
+        wins=('win','sum'),
+        avg_profit=('profit','mean')
+    ).reset_index()
+    return agg.to_dict('records'), [{"name":c, "id":c} for c in agg.columns]
+
+def backtest_job(args, progress):
+    params = dict(DEFAULT_PARAMS, **args["params"])
+    start = date.fromisoformat(args["start"])
+    end = date.fromisoformat(args["end"])
+    engine = get_engine()
+    occ, info = run_backtest_cached(engine, args["symbol"], "minute", start, end, params, POLYGON_API_KEY,
+                                    progress=lambda done, total: progress(done, total, f"{done}/{total} days"))
+    if not info['days']:
+        return {"summary": "No data found in range.", "rows": [], "cols": []}
+    with metrics.stage("aggregation"):
+        stats = summarize_events(occ)
+        if engine is not None and info.get("per_day") and end < today_et():
+            # this run's new days are still in the write-behind queue
+            writer.flush()
+            rows, cols = period_rollup(engine, [args["symbol"]], "minute", params_hash(params), start, end)
+            if sum(r["patterns"] for r in rows) != len(occ):
+                # a day's write failed (the writer only logs it): the stored
+                # days no longer add up to this run
+                rows, cols = period_rows(occ, start, end)
+        else:
+            rows, cols = period_rows(occ, start, end)
+    summary = f"Patterns: {stats['patterns']} | Win%: {stats['win_rate_pct']:.1f}% | Avg P/L: ${stats['avg_profit']:.02f}"
+    return {"summary": summary, "rows": rows, "cols": cols}
+
+def universe_job(args, progress):
+    # One parameter set over a symbol list: the period table as for a single
+    # symbol plus a per-symbol leaderboard.
+    params = dict(DEFAULT_PARAMS, **args["params"])
+    start = date.fromisoformat(args["start"])
+    end = date.fromisoformat(args["end"])
+    symbols = args["symbols"]
+    occ, n_bars = run_universe(get_engine(), symbols, "minute", start, end, params, POLYGON_API_KEY,
+                               progress=lambda done, total: progress(done, total, f"{done}/{total} symbols"))
+    if not any(n_bars.values()):
+        return {"summary": "No data found in range.", "rows": [], "cols": [], "leaders": [], "leader_cols": []}
+    with metrics.stage("aggregation"):
+        stats = summarize_events(occ)
+        rows, cols = period_rows(occ, start, end)
+        leaders, leader_cols = leaderboard(occ, n_bars)
+    summary = (f"Symbols: {sum(1 for n in n_bars.values() if n)}/{len(symbols)} | Patterns: {stats['patterns']} | "
+               f"Win%: {stats['win_rate_pct']:.1f}% | Avg P/L: ${stats['avg_profit']:.02f}")
+    return {"summary": summary, "rows": rows, "cols": cols, "leaders": leaders, "leader_cols": leader_cols}
+
+def fine_tune_job(args, progress):
+    engine = get_engine()
+    symbol = args["symbol"]
+    start = date.fromisoformat(args["start"])
+    end = date.fromisoformat(args["end"])
+    grid_mode = args.get("grid_mode", "table")
+    if grid_mode in GRID_GENERATORS:
+        params_list = GRID_GENERATORS[grid_mode](int(args.get("grid_size") or 1))
+        rows = [dict(set_id=i, **p) for i, p in enumerate(params_list, 1)]
+    else:
+        rows = args["rows"]
+        params_list = [{k:r[k] for k in r if k!="set_id"} for r in rows]
+
+    days = trading_days(start, end)
+    note = ""
+    if args.get("search") == "halving":
+        # Sets are dropped on a sample of days and only survivors see them
+        # all, so the days are held for the whole search. Progress counts
+        # loaded days, then scored set-days.
+        day_frames = {}
+        progress(0, len(days), f"0/{len(days)} days loaded")
+        for i, (d, df) in enumerate(iter_candle_days(engine, symbol, "second", days, POLYGON_API_KEY,
+                                                     SWEEP_LOAD_DAYS), 1):
+            if not df.empty:
+                day_frames[d] = df
+            progress(i, len(days), f"{i}/{len(days)} days loaded")
+        if not day_frames:
+            return {"rows": [], "cols": []}
+        set_metrics, info = successive_halving(
+            day_frames, params_list,
+            progress=lambda n, planned: progress(len(days) + n, len(days) + planned, f"{n}/{planned} set-days"))
+        note = (f"Successive halving: {info['rounds']} rounds, {info['runs']:,} set-days scored "
+                f"instead of {info['exhaustive_runs']:,}.")
+    else:
+        # Streamed through the pool a day at a time, so memory stays at a
+        # couple of days of bars however long the range.
+        loaded = []
+        def frames():
+            for _, df in iter_candle_days(engine, symbol, "second", days, POLYGON_API_KEY):
+                if not df.empty:
+                    loaded.append(len(df))
+                yield df
+        progress(0, len(days), f"0/{len(days)} days")
+        set_metrics = run_sweep_days(frames(), params_list,
+                                     progress=lambda n: progress(n, len(days), f"{n}/{len(days)} days"))
+        if not loaded:
+            return {"rows": [], "cols": []}
+    if engine:
+        writer.submit(save_sweep_results, engine, symbol, start, end, params_list, set_metrics)
+
+    results = []
+    for r, m in zip(rows, set_metrics):
+        res = {
+            "set_id": r["set_id"],
+            "patterns": m["patterns"],
+            "win_rate_pct": round(m["win_rate_pct"],1),
+            "avg_profit": round(m["avg_profit"], 4)
+        }
+        if "days" in m:
+            res.update(total_profit=round(m["total_profit"], 4), days=m["days"])
+        if grid_mode in GRID_GENERATORS:
+            res.update({k: r[k] for k in DEFAULT_PARAMS})
+        results.append(res)
+    cols = [{"name":c, "id":c} for c in results[0].keys()] if results else []
+    return {"rows": results, "cols": cols, "note": note}
+
+HANDLERS = {"backtest": backtest_job, "universe": universe_job, "fine_tune": fine_tune_job}
@@ -0,0 +1,189 @@
+from datetime import date
+
+import pandas as pd
+import pytest
+
+import features
+import hl_fsm
+from hl_fsm import DEFAULT_PARAMS, bars_from_df, detect_hl_patterns, detect_hl_patterns_batch, params_matrix
+from synthetic import synthetic_bars
+
+# The array kernel (and its feature-index skips on second bars) must match
+# the original row-by-row detector exactly, events and marks alike.
+
+def reference_detect(df, p):
+    # The detector as it was before the array kernel (event dicts factored
+    # into event()).
+    events = []
+    marks = []
+
+    phase = 1
+    a0 = None; a1 = None; a2 = None
+    a0_confirmed_at = None
+    a1_confirmed_at = None
+    start_time = None
+    in_trade = False
+    entry_price = None
+    entry_time = None
+
+    wait_after_confirm = pd.Timedelta(milliseconds=p['time_to_wait_before_confirm_Ax_ms'])
+    time_limit = pd.Timedelta(milliseconds=p['pattern_time_limit_ms'])
+
+    def reset():
+        nonlocal phase, a0, a1, a2, a0_confirmed_at, a1_confirmed_at, start_time, in_trade, entry_price, entry_time
+        phase = 1
+        a0 = a1 = a2 = None
+        a0_confirmed_at = a1_confirmed_at = None
+        start_time = None
+        in_trade = False
+        entry_price = None
+        entry_time = None
+
+    def disruption(candle_low):
+        if a0 is None:
+            return False
+        return (a0['low'] - candle_low) > p['max_decrease_below_A0']
+
+    def event(ts, exit_price, outcome, profit):
+        return {
+            "a0_time": a0['time'], "a0_low": a0['low'],
+            "a1_time": a1['time'] if a1 else None, "a1_low": a1['low'] if a1 else None,
+            "a2_time": a2['time'] if a2 else None, "a2_low": a2['low'] if a2 else None,
+            "entry_time": entry_time, "entry_price": entry_price,
+            "exit_time": ts, "exit_price": exit_price,
+            "outcome": outcome, "profit": profit
+        }
+
+    for i, row in df.iterrows():
+        ts = row['ts']; low = row['low']; close = row['close']
+        if start_time is None:
+            start_time = ts
+
+        if (ts - start_time) > time_limit:
+            reset()
+            start_time = ts
+
+        if phase == 1:
+            if i > 0 and low < df.iloc[i-1]['low']:
+                if (a0 is None) or (low < a0['low']):
+                    a0 = dict(time=ts, low=low)
+                    marks.append({"ts": ts, "price": low, "label": "A0?"})
+            if a0 and close >= a0['low'] + p['price_increase_to_confirm_A0']:
+                a0_confirmed_at = ts
+                phase = 2
+                start_time = ts
+                marks.append({"ts": ts, "price": close, "label": "A0✓"})
+                continue
+
+        elif phase == 2:
+            if (ts - a0_confirmed_at) < wait_after_confirm:
+                if low < a0['low']:
+                    a0 = dict(time=ts, low=low)
+                    marks.append({"ts": ts, "price": low, "label": "A0*"})
+                continue
+            if i > 0 and low < df.iloc[i-1]['low']:
+                if (low > a0['low']) and (low <= a0['low'] + p['max_price_increase_above_A0']):
+                    if (a1 is None) or (low < a1['low']):
+                        a1 = dict(time=ts, low=low)
+                        marks.append({"ts": ts, "price": low, "label": "A1?"})
+            if a1 and close >= a1['low'] + p['price_increase_to_confirm_higher_low']:
+                a1_confirmed_at = ts
+                phase = 3
+                start_time = ts
+                marks.append({"ts": ts, "price": close, "label": "A1✓"})
+                continue
+            if disruption(low):
+                reset(); start_time = ts; continue
+
+        elif phase == 3:
+            if (ts - a1_confirmed_at) < wait_after_confirm:
+                if a1 and low < a1['low']:
+                    a1 = dict(time=ts, low=low)
+                    marks.append({"ts": ts, "price": low, "label": "A1*"})
+                continue
+            if i > 0 and low < df.iloc[i-1]['low']:
+                if (low > a0['low']) and (low <= a0['low'] + p['max_price_increase_above_A0']):
+                    if (a2 is None) or (low < a2['low']):
+                        a2 = dict(time=ts, low=low)
+                        marks.append({"ts": ts, "price": low, "label": "A2?"})
+            if a2 and close >= a2['low'] + p['price_increase_to_confirm_higher_low']:
+                phase = 4
+                start_time = ts
+                marks.append({"ts": ts, "price": close, "label": "A2✓"})
+                continue
+            if disruption(low):
+                reset(); start_time = ts; continue
+
+        elif phase == 4:
+            if a2 and close <= (a2['low'] + p['price_increase_from_A2_to_enter_trade']):
+                in_trade = True
+                entry_price = close
+                entry_time = ts
+                marks.append({"ts": ts, "price": close, "label": "BUY"})
+                phase = 5
+                start_time = ts
+                continue
+            if disruption(low):
+                reset(); start_time = ts; continue
+
+        elif phase == 5:
+            if in_trade:
+                if row['high'] >= entry_price + p['take_profit_offset']:
+                    events.append(event(ts, entry_price + p['take_profit_offset'], "take_profit", p['take_profit_offset']))
+                    reset(); start_time = ts; continue
+                if row['low'] <= entry_price - p['stop_loss_offset']:
+                    events.append(event(ts, entry_price - p['stop_loss_offset'], "stop_loss", -p['stop_loss_offset']))
+                    reset(); start_time = ts; continue
+                if (ts - entry_time) >= pd.Timedelta(milliseconds=p['trade_timeout_ms']):
+                    events.append(event(ts, row['close'], "timeout", row['close'] - entry_price))
+                    reset(); start_time = ts; continue
+
+    return events, marks
+
+PARAM_SETS = [
+    DEFAULT_PARAMS,
+    # short time limit: frequent resets mid-pattern
+    dict(DEFAULT_PARAMS, pattern_time_limit_ms=5*60*1000, time_to_wait_before_confirm_Ax_ms=60*1000),
+    # tight stop and timeout: stop losses and timeouts as well as take profits
+    dict(DEFAULT_PARAMS, stop_loss_offset=0.02, take_profit_offset=0.30, trade_timeout_ms=3*60*1000),
+    # loose confirmations, strict disruption
+    dict(DEFAULT_PARAMS, price_increase_to_confirm_A0=0.02, price_increase_to_confirm_higher_low=0.02,
+         max_decrease_below_A0=0.05, max_price_increase_above_A0=0.20),
+]
+
+@pytest.fixture(scope="module")
+def minute_bars():
+    return synthetic_bars(date(2024, 3, 4), date(2024, 3, 6), "minute", seed=1)
+
+@pytest.fixture(scope="module")
+def second_bars():
+    # Long enough for run_kernel to build a feature index, short enough for
+    # the iterrows reference.
+    df = synthetic_bars(date(2024, 3, 4), date(2024, 3, 4), "second", seed=2, patterns_per_day=12)
+    return df.iloc[:8000].reset_index(drop=True)
+
+def _check(df, p):
+    assert detect_hl_patterns(df, p) == reference_detect(df, p)
+
+@pytest.mark.parametrize("p", PARAM_SETS)
+def test_minute_bars_match_reference(minute_bars, p):
+    _check(minute_bars, p)
+
+@pytest.mark.parametrize("p", PARAM_SETS)
+def test_second_bars_match_reference(second_bars, p):
+    bars = bars_from_df(second_bars)
+    assert len(bars[0]) >= hl_fsm.INDEX_MIN_BARS
+    assert features.FeatureIndex(*bars).worth_skipping(p)
+    _check(second_bars, p)
+
+def test_parameter_sets_trade(minute_bars, second_bars):
+    # The fixtures exercise the whole FSM, not just the A0 search.
+    outcomes = set()
+    for df in (minute_bars, second_bars):
+        for p in PARAM_SETS:
+            outcomes.update(e["outcome"] for e in reference_detect(df, p)[0])
+    assert outcomes == {"take_profit", "stop_loss", "timeout"}
+
+def test_batch_matches_reference(second_bars):
+    events = detect_hl_patterns_batch(*bars_from_df(second_bars), params_matrix(PARAM_SETS))
+    assert events == [reference_detect(second_bars, p)[0] for p in PARAM_SETS]
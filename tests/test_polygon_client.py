@@ -0,0 +1,93 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import pytest
+
+import polygon_client
+from polygon_client import PolygonError, fetch_aggs_range
+
+# fetch_aggs_range against a local stub of the aggregates endpoint, which
+# plays back scripted (status, headers, body) responses in order.
+
+def _bar(t, price):
+    return {"t": t, "o": price, "h": price + 1, "l": price - 1, "c": price, "v": 100, "vw": price, "n": 3}
+
+class StubServer:
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                stub.requests.append((url.path, parse_qs(url.query)))
+                status, headers, body = stub.responses.pop(0)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.root = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = StubServer()
+    monkeypatch.setattr(polygon_client, "BASE", server.root + "/v2/aggs/ticker/{symbol}/range/{mult}/{res}/{start}/{end}")
+    yield server
+    server.close()
+
+def test_follows_next_url_and_resends_key(stub):
+    stub.responses = [
+        (200, {}, {"results": [_bar(1000, 10.0), _bar(2000, 11.0)], "next_url": stub.root + "/v2/aggs/cursor/abc"}),
+        (200, {}, {"results": [_bar(3000, 12.0)]}),
+    ]
+    df = fetch_aggs_range("aapl", 1, "minute", "2024-03-04", "2024-03-05", "KEY")
+
+    assert df['ts'].tolist() == [pd.Timestamp(ms, unit="ms", tz="UTC") for ms in (1000, 2000, 3000)]
+    assert df['close'].tolist() == [10.0, 11.0, 12.0]
+    assert (df['symbol'] == "AAPL").all()
+    (first, q1), (cursor, q2) = stub.requests
+    assert first == "/v2/aggs/ticker/AAPL/range/1/minute/2024-03-04/2024-03-05"
+    assert q1["apiKey"] == ["KEY"] and q1["sort"] == ["asc"]
+    # the cursor page gets the key and nothing else
+    assert cursor == "/v2/aggs/cursor/abc" and q2 == {"apiKey": ["KEY"]}
+
+def test_retries_rate_limits_and_server_errors(stub):
+    stub.responses = [
+        (429, {"Retry-After": "0"}, {"status": "ERROR"}),
+        (503, {"Retry-After": "0"}, {"status": "ERROR"}),
+        (200, {}, {"results": [_bar(1000, 10.0)]}),
+    ]
+    df = fetch_aggs_range("AAPL", 1, "minute", "2024-03-04", "2024-03-04", "KEY")
+
+    assert len(df) == 1
+    assert len(stub.requests) == 3
+
+def test_client_errors_are_not_retried(stub):
+    stub.responses = [(403, {}, {"status": "NOT_AUTHORIZED"})]
+    with pytest.raises(PolygonError) as e:
+        fetch_aggs_range("AAPL", 1, "minute", "2024-03-04", "2024-03-04", "KEY")
+
+    assert e.value.status == 403
+    assert len(stub.requests) == 1
+
+def test_empty_range(stub):
+    stub.responses = [(200, {}, {"resultsCount": 0})]
+    assert fetch_aggs_range("AAPL", 1, "minute", "2024-03-04", "2024-03-04", "KEY").empty
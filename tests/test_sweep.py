@@ -0,0 +1,63 @@
+from datetime import date
+
+import pytest
+
+from hl_fsm import DEFAULT_PARAMS, run_backtest_on_df, summarize_events
+from polygon_client import split_by_day
+from sweep import run_sweep_days, successive_halving
+from synthetic import synthetic_bars
+
+# Day-by-day sweeps must score every set as one run over the whole range
+# would, including sets whose time limit outlasts the overnight gap.
+
+PARAM_SETS = [
+    DEFAULT_PARAMS,
+    dict(DEFAULT_PARAMS, pattern_time_limit_ms=5*60*1000, stop_loss_offset=0.02),
+    # longer than the gap between sessions: the state runs on overnight
+    dict(DEFAULT_PARAMS, pattern_time_limit_ms=24*60*60*1000),
+    dict(DEFAULT_PARAMS, pattern_time_limit_ms=24*60*60*1000, trade_timeout_ms=24*60*60*1000,
+         take_profit_offset=2.0),
+]
+
+@pytest.fixture(scope="module")
+def bars():
+    return synthetic_bars(date(2024, 3, 4), date(2024, 3, 12), "minute", seed=3)
+
+@pytest.fixture(scope="module")
+def expected(bars):
+    return [summarize_events(run_backtest_on_df(bars, p)) for p in PARAM_SETS]
+
+def _close(got, want):
+    assert [m["patterns"] for m in got] == [m["patterns"] for m in want]
+    for g, w in zip(got, want):
+        assert g["win_rate_pct"] == pytest.approx(w["win_rate_pct"])
+        assert g["avg_profit"] == pytest.approx(w["avg_profit"])
+
+def test_days_match_whole_range(bars, expected):
+    frames = list(split_by_day(bars).values())
+    _close(run_sweep_days(frames, PARAM_SETS, workers=1), expected)
+
+def test_days_match_whole_range_in_pool(bars, expected):
+    # enough sets to go through the process pool
+    params = PARAM_SETS * 9
+    frames = list(split_by_day(bars).values())
+    _close(run_sweep_days(frames, params, workers=2), expected * 9)
+
+def test_halving_matches_whole_range(bars, expected):
+    day_frames = split_by_day(bars)
+    # min_days covering the range: one round, every set on every day
+    out, info = successive_halving(day_frames, PARAM_SETS, min_days=len(day_frames), workers=1)
+    assert info["rounds"] == 1
+    _close(out, expected)
+    # several rounds: whoever saw every day has the whole range's metrics
+    out, info = successive_halving(day_frames, PARAM_SETS, eta=2, workers=1)
+    assert info["rounds"] > 1
+    full = [(m, w) for m, w in zip(out, expected) if m["days"] == len(day_frames)]
+    assert full
+    _close(*map(list, zip(*full)))
+
+def test_long_limit_differs_from_fresh_days(bars, expected):
+    # the fixture really does carry patterns across the overnight gap
+    per_day = [summarize_events(run_backtest_on_df(df, PARAM_SETS[2]))["patterns"]
+               for df in split_by_day(bars).values()]
+    assert sum(per_day) != expected[2]["patterns"]
@@ -0,0 +1,112 @@
+import os
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from hl_fsm import bars_from_df, detect_hl_patterns_arrays, summarize_events
+from candle_store import load_candles
+
+# Backtests one parameter set over a list of symbols. Bars are loaded in this
+# process by a few threads sharing the pooled engine and Polygon session, and
+# the detector runs per symbol in a process pool, so loading and detection
+# overlap and detection scales with the cores.
+
+LOADER_THREADS = int(os.environ.get("UNIVERSE_LOADER_THREADS", "4"))
+# Loaded symbols waiting for a worker, per worker; bounds memory on large
+# universes when loading outruns detection.
+PREFETCH_PER_WORKER = 2
+
+def parse_symbols(text):
+    # Upper-cased symbols from a comma/whitespace separated list, first
+    # occurrence kept.
+    seen = []
+    for s in re.split(r"[\s,;]+", text or ""):
+        s = s.strip().upper()
+        if s and s not in seen:
+            seen.append(s)
+    return seen
+
+def _detect(symbol, ts, low, high, close, params):
+    events, _ = detect_hl_patterns_arrays(ts, low, high, close, params, collect_marks=False)
+    for e in events:
+        e["symbol"] = symbol
+    return symbol, len(ts), events
+
+def run_universe(engine, symbols, res, start, end, params, api_key, workers=None, progress=None):
+    # Events of every symbol (each tagged with "symbol") and per-symbol bar
+    # counts. progress(done, total) is called as symbols finish; an exception
+    # raised from it stops the run.
+    symbols = list(symbols)
+    if not symbols:
+        return [], {}
+    workers = workers or os.cpu_count() or 1
+    slots = threading.Semaphore(workers * PREFETCH_PER_WORKER)
+    stop = threading.Event()
+
+    def load(symbol):
+        slots.acquire()
+        if stop.is_set():
+            return None
+        try:
+            df = load_candles(engine, symbol, res, start, end, api_key)
+        except BaseException:
+            slots.release()
+            raise
+        if df.empty:
+            slots.release()
+            return None
+        return bars_from_df(df)
+
+    events, n_bars = [], {}
+    with ThreadPoolExecutor(max_workers=min(LOADER_THREADS, len(symbols))) as loaders, \
+         ProcessPoolExecutor(max_workers=min(workers, len(symbols))) as pool:
+        # future -> (symbol, is_detect)
+        pending = {loaders.submit(load, s): (s, False) for s in symbols}
+        try:
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    symbol, is_detect = pending.pop(f)
+                    if not is_detect:
+                        bars = f.result()
+                        if bars is not None:
+                            pending[pool.submit(_detect, symbol, *bars, params)] = (symbol, True)
+                            continue
+                        n_bars[symbol] = 0
+                    else:
+                        slots.release()
+                        _, n_bars[symbol], ev = f.result()
+                        events.extend(ev)
+                    if progress:
+                        progress(len(n_bars), len(symbols))
+        except BaseException:
+            stop.set()
+            for f in pending:
+                f.cancel()
+            # wake loaders waiting on a slot so the thread pool can exit
+            for _ in range(LOADER_THREADS):
+                slots.release()
+            pool.shutdown(wait=True, cancel_futures=True)
+            raise
+    return events, n_bars
+
+def leaderboard(events, n_bars):
+    # One row per symbol, best total profit first; symbols without bars are
+    # left out.
+    by_symbol = {s: [] for s, n in n_bars.items() if n}
+    for e in events:
+        by_symbol.setdefault(e["symbol"], []).append(e)
+    rows = []
+    for s, ev in by_symbol.items():
+        st = summarize_events(ev)
+        rows.append({
+            "symbol": s,
+            "bars": n_bars.get(s, 0),
+            "patterns": st["patterns"],
+            "win_rate_pct": round(st["win_rate_pct"], 1),
+            "avg_profit": round(st["avg_profit"], 4),
+            "total_profit": round(float(sum(e["profit"] for e in ev)), 4)
+        })
+    rows.sort(key=lambda r: (-r["total_profit"], r["symbol"]))
+    cols = [{"name":c, "id":c} for c in rows[0].keys()] if rows else []
+    return rows, cols